@@ -0,0 +1,215 @@
+# バッチ実行用CLI（Streamlit UI を開かずに判定する）
+# 例: python batch_cli.py urls.txt --jsonl results.jsonl --sheet
+#     cat urls.txt | python batch_cli.py - > results.jsonl
+#     python batch_cli.py urls.txt --create-job --sheet   # ジョブとして登録し、途中結果を残しながら処理
+#     python batch_cli.py --job <ジョブID> --sheet         # 中断したジョブの再開・別プロセスからの参加
+# OCRのプロセスプールは spawn で起動するため、処理は必ず __main__ ガードの中で始めること
+import argparse, json, sys, time
+from concurrent.futures import wait
+
+import streamlit.logger
+import web_unsafe_list as app
+
+# Streamlit の外で動かすと st.cache_resource などが毎回「bare mode」の警告を出すので抑える
+streamlit.logger.set_log_level("error")
+
+
+def read_urls(stream):
+    # 1行1URL。空行と # で始まる行は読み飛ばし、正規化して重複は1回だけ流す
+    seen = set()
+    for line in stream:
+        url = line.strip()
+        if not url or url.startswith("#"):
+            continue
+        url = app.normalize_url(url)
+        if url not in seen:
+            seen.add(url)
+            yield url
+
+def parse_workers(values) -> dict:
+    workers = app.load_pipeline_workers()
+    for value in values or []:
+        name, _, count = value.partition("=")
+        if name not in workers or not count.isdigit():
+            raise argparse.ArgumentTypeError(f"--workers は stage=数 の形式で指定してください（stage: {', '.join(workers)}）: {value}")
+        workers[name] = max(1, int(count))
+    return workers
+
+def to_record(item: dict) -> dict:
+    result = dict(item.get("result") or {})
+    upload = item.get("upload")
+    if upload is not None:
+        result["drive_url"] = upload.result() if upload.exception() is None else ""
+    return {
+        "idx": item["idx"],
+        "url": item["url"],
+        "error": item.get("error", ""),
+        "cache_hit": bool(item.get("cache_hit")),
+        "cascade": item.get("cascade", {}).get("tier", ""),
+        **result,
+        "timings": {name: round(seconds, 3) for name, seconds in item["timings"].items()},
+    }
+
+def write_metrics(recorder, args):
+    if args.metrics_json:
+        with open(args.metrics_json, "w", encoding="utf-8") as f:
+            f.write(recorder.to_json())
+    if args.metrics_prom:
+        with open(args.metrics_prom, "w", encoding="utf-8") as f:
+            f.write(recorder.to_prometheus())
+    for name, value in sorted(recorder.counters.items()):
+        print(f"  {app.COUNTER_LABELS.get(name, name)}: {value}件", file=sys.stderr)
+    for row in recorder.summary():
+        print(f"  {row['区間']:20s} {row['件数']:>6}件  エラー {row['エラー']:>4}  p50 {row['p50秒']:.3f}s  p95 {row['p95秒']:.3f}s  合計 {row['合計秒']:.1f}s", file=sys.stderr)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="URL一覧を判定し、JSONL とシートに書き出す")
+    parser.add_argument("input", nargs="?", default="-", help="URL一覧のファイル（省略時・- は標準入力）")
+    parser.add_argument("--jsonl", help="JSONL の出力先（- は標準出力）。--sheet を付けない時の既定は標準出力")
+    parser.add_argument("--sheet", action="store_true", help="結果をスプレッドシートにも書き込む")
+    parser.add_argument("--upload", action="store_true", help="スクショを Drive にアップロードする（--sheet の時は常に行う）")
+    parser.add_argument("--readiness", default=app.READINESS_PROFILE, choices=list(app.READINESS_PROFILES))
+    parser.add_argument("--no-cache", action="store_true", help="結果キャッシュを使わない")
+    parser.add_argument("--no-near-dup", action="store_true", help="近似重複ページの判定の流用をしない")
+    parser.add_argument("--workers", nargs="*", metavar="STAGE=N", help="ステージごとのワーカー数（例: render=4 gpt=8）")
+    parser.add_argument("--create-job", action="store_true", help="URL一覧をジョブとして登録してから処理する（中断しても --job で再開できる）")
+    parser.add_argument("--job", metavar="JOB_ID", help="登録済みのジョブを処理する（input は読まない。複数プロセスで同時に実行してよい）")
+    parser.add_argument("--metrics-json", metavar="PATH", help="区間ごとの所要時間を JSON で保存する")
+    parser.add_argument("--metrics-prom", metavar="PATH", help="区間ごとの所要時間を Prometheus のテキスト形式で保存する")
+    parser.add_argument("--profile", metavar="URL", help="このURL1件だけを cProfile 付きで処理して結果を表示する（シートには書かない）")
+    parser.add_argument("--progress-every", type=int, default=100, help="この件数ごとに標準エラーへ進捗を出す")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        workers = parse_workers(args.workers)
+    except argparse.ArgumentTypeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+
+    missing_vars = app.missing_env_vars()
+    if missing_vars:
+        print(f"❌ 次の変数が設定されてません。: {', '.join(missing_vars)}", file=sys.stderr)
+        return 2
+
+    if args.profile:
+        stats_text, raw_profile, recorder = app.profile_url(args.profile, args.readiness)
+        print(stats_text, file=sys.stderr)
+        with open("profile.prof", "wb") as f:
+            f.write(raw_profile)
+        print("cProfile の結果を profile.prof に保存しました。", file=sys.stderr)
+        write_metrics(recorder, args)
+        return 0
+
+    jsonl_path = args.jsonl or (None if args.sheet else "-")
+    out = None
+    if jsonl_path == "-":
+        out = sys.stdout
+    elif jsonl_path:
+        out = open(jsonl_path, "a", encoding="utf-8")
+    source = None if args.job else sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+
+    recorder = app.SpanRecorder()
+    writer = app.SheetWriter(app.get_worksheet(), recorder=recorder) if args.sheet else None
+    cache = None if args.no_cache else app.get_result_cache()
+    uploader = app.DriveUploader() if args.sheet or args.upload else None
+    dup_index = None if args.no_near_dup else app.get_near_dup_index()
+    store = worker_id = None
+    if args.job or args.create_job:
+        store = app.get_job_store()
+        job_id = args.job or store.create_job(list(read_urls(source)), args.readiness)
+        print(f"ジョブID: {job_id}", file=sys.stderr)
+        worker_id = store.open_worker()
+        pipeline = app.UrlPipeline(app.build_job_stages(store, writer, cache, uploader, dup_index), workers, recorder=recorder)
+        items = store.items(job_id, worker_id)
+    else:
+        pipeline = app.UrlPipeline(app.build_pipeline_stages(writer, cache, uploader, dup_index), workers, recorder=recorder)
+        items = (
+            {"idx": idx, "url": url, "readiness": args.readiness, "timings": {}}
+            for idx, url in enumerate(read_urls(source), 1)
+        )
+
+    start_time = time.time()
+    done_count = error_count = 0
+    decided = {}  # 段階判定で確定した件数
+    preclassified = 0
+    near_dup_sources = []  # 近似重複で流用した元のURL（クラスタの集計用）
+    exit_code = 0
+    pending = []  # アップロード待ちの item（URLが確定してから書き出す）
+
+    def emit(ready):
+        nonlocal error_count
+        # エラーはここで1回だけ数える（アップロード後のコールバックで付いたエラーもここで拾う）
+        for item in ready:
+            if item.get("error"):
+                error_count += 1
+                stage = "書き込み準備" if item.get("upload") is not None and item["upload"].exception() is not None else "処理"
+                print(f"[{item['idx']}] {item['url']} の{stage}中にエラー発生: {item['error']}", file=sys.stderr)
+            if out is not None:
+                out.write(json.dumps(to_record(item), ensure_ascii=False) + "\n")
+        if out is not None and ready:
+            out.flush()
+
+    try:
+        for item in pipeline.run(items):
+            if store is not None:
+                store.settle(item)
+            app.cleanup_item(item)
+            done_count += 1
+            if item.get("cascade"):
+                tier = item["cascade"]["tier"]
+                decided[tier] = decided.get(tier, 0) + 1
+            if item.get("near_dup"):
+                near_dup_sources.append(item["near_dup"]["url"])
+            if app.is_preclassified(item):
+                preclassified += 1
+            pending.append(item)
+            ready = [p for p in pending if p.get("upload") is None or p["upload"].done()]
+            pending = [p for p in pending if not (p.get("upload") is None or p["upload"].done())]
+            emit(ready)
+
+            if args.progress_every and done_count % args.progress_every == 0:
+                elapsed = time.time() - start_time
+                print(f"進行中: {done_count}件 / {done_count / elapsed * 60:.1f}件/分 / エラー {error_count}件", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("中断しました。書き込み済みの結果を保存します…", file=sys.stderr)
+    finally:
+        wait([p["upload"] for p in pending])
+        emit(pending)
+        if uploader is not None:
+            uploader.close()
+            for error in uploader.errors:
+                print(f"❌ Drive アップ失敗: {error}", file=sys.stderr)
+            if uploader.permission_errors:
+                print(f"⚠️ 公開権限の設定に失敗しました（{len(uploader.permission_errors)}件）: {uploader.permission_errors[0]}", file=sys.stderr)
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                print(f"❌ シート書き込み失敗: {e}", file=sys.stderr)
+                exit_code = 1
+        if store is not None:
+            store.close_worker(worker_id)
+        if out is not None and out is not sys.stdout:
+            out.close()
+        if source is not None and source is not sys.stdin:
+            source.close()
+
+    write_metrics(recorder, args)
+    clusters = app.near_dup_clusters(near_dup_sources)
+    if clusters:
+        print(f"近似重複: {sum(c['件数'] - 1 for c in clusters)}件は判定済みページの結果を流用しました（クラスタ {len(clusters)}個）", file=sys.stderr)
+        for cluster in clusters[:10]:
+            print(f"  {cluster['件数']:>5}件  {cluster['代表URL']}", file=sys.stderr)
+    if preclassified:
+        print(f"事前分類: GPT本文判定を {preclassified}件省略しました", file=sys.stderr)
+    if decided:
+        print("段階判定で確定: " + " / ".join(f"{app.CASCADE_TIER_LABELS[tier]} {count}件" for tier, count in decided.items()), file=sys.stderr)
+    total_min, total_sec = divmod(int(time.time() - start_time), 60)
+    print(f"判定完了 ✅ {done_count}件（エラー {error_count}件） 所要時間: {total_min}分{total_sec}秒", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# OpenAI / Drive / Sheets の代わりに使うローカルのスタンドイン（応答の遅延は指定できる）
+import json, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENRE_ANSWERS = [
+    "[ジャンル]: 要確認\n[理由]: 該当する表現は見当たりません",
+    "[ジャンル]: ポイント\n[理由]: ポイント交換の案内があります",
+    "[ジャンル]: 悪質CGM\n[理由]: 掲示板形式の投稿が多数あります",
+]
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        request = json.loads(body or b"{}")
+        # 同じ入力には同じ答えを返す
+        answer = GENRE_ANSWERS[len(body) % len(GENRE_ANSWERS)]
+        payload = json.dumps({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": 30, "total_tokens": len(body) // 4 + 30},
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("x-ratelimit-limit-requests", "10000")
+        self.send_header("x-ratelimit-remaining-requests", "9999")
+        self.send_header("x-ratelimit-reset-requests", "6ms")
+        self.send_header("x-ratelimit-limit-tokens", "2000000")
+        self.send_header("x-ratelimit-remaining-tokens", "1999000")
+        self.send_header("x-ratelimit-reset-tokens", "30ms")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_openai(latency: float = 0.0, host: str = "127.0.0.1") -> tuple[ThreadingHTTPServer, str]:
+    handler = type("Handler", (FakeOpenAIHandler,), {"latency": latency})
+    server = ThreadingHTTPServer((host, 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+class FakeWorksheet:
+    # gspread.Worksheet のうち SheetWriter が使うメソッドだけ
+    def __init__(self, urls: list, latency: float = 0.0):
+        self.rows = [[url] for url in urls]
+        self.latency = latency
+        self.calls = 0
+        self.cells = 0
+        self._lock = threading.Lock()
+
+    def col_values(self, col: int) -> list:
+        time.sleep(self.latency)
+        return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def get_all_values(self) -> list:
+        time.sleep(self.latency)
+        return [list(row) for row in self.rows]
+
+    def batch_update(self, data: list, value_input_option: str = "RAW"):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            self.cells += sum(len(values) for entry in data for values in entry["values"])
+
+class _Request:
+    def __init__(self, latency: float, result: dict):
+        self.latency = latency
+        self.result = result
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.result
+
+class _Batch:
+    def __init__(self, latency: float, callback):
+        self.latency = latency
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        time.sleep(self.latency)
+        for request_id, request in self.requests:
+            self.callback(request_id, request.result, None)
+
+class FakeDriveService:
+    # googleapiclient の Drive v3 サービスのうち、アップロードと権限付与で使う部分だけ
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.uploads = 0
+        self.permissions_granted = 0
+        self._lock = threading.Lock()
+
+    def files(self):
+        return self
+
+    def permissions(self):
+        return _Permissions(self)
+
+    def create(self, body=None, media_body=None, **kwargs):
+        with self._lock:
+            self.uploads += 1
+        return _Request(self.latency, {"id": uuid.uuid4().hex})
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self.latency, callback)
+
+class _Permissions:
+    def __init__(self, drive: FakeDriveService):
+        self.drive = drive
+
+    def create(self, fileId=None, **kwargs):
+        with self.drive._lock:
+            self.drive.permissions_granted += 1
+        return _Request(self.drive.latency, {"id": "anyoneWithLink"})
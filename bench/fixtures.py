@@ -0,0 +1,108 @@
+# ベンチマーク用のフィクスチャページ（ローカルHTTPサーバーで配信する）
+# 乱数の種を固定して生成するので、コミット間で同じ内容のページになる
+import io, random, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw
+
+KINDS = ("short-ja", "short-en", "long-ja", "infinite-scroll", "image-heavy", "forbidden", "missing")
+
+JA_WORDS = [
+    "今日", "天気", "ニュース", "レシピ", "旅行", "ホテル", "口コミ", "ランキング", "おすすめ", "比較",
+    "無料", "ポイント", "漫画", "アニメ", "映画", "音楽", "掲示板", "投稿", "コメント", "ログイン",
+    "健康", "医療", "保険", "転職", "求人", "車", "不動産", "料理", "子育て", "スポーツ",
+]
+EN_WORDS = [
+    "today", "weather", "news", "recipe", "travel", "hotel", "review", "ranking", "best", "compare",
+    "free", "points", "comic", "anime", "movie", "music", "forum", "post", "comment", "login",
+]
+
+BENCH_RULES = {
+    "genre_keywords": {
+        "ポイント": ["ポイント", "無料", "points"],
+        "悪質CGM": ["掲示板", "投稿", "forum"],
+        "著作権侵害": ["漫画", "アニメ", "comic"],
+    },
+    "url_patterns": {
+        "悪質CGM": ["/bbs/", "forum."],
+    },
+    "japanese_domains": [".jp", "co.jp"],
+}
+
+def _sentence(rng: random.Random, words: list, joiner: str, length: int) -> str:
+    return joiner.join(rng.choice(words) for _ in range(length))
+
+def _paragraphs(rng: random.Random, words: list, joiner: str, count: int) -> str:
+    return "\n".join(f"<p>{_sentence(rng, words, joiner, rng.randint(12, 30))}。</p>" for _ in range(count))
+
+def _page(title: str, body: str, lang: str = "ja") -> str:
+    return (
+        f'<!DOCTYPE html><html lang="{lang}"><head><meta charset="utf-8"><title>{title}</title></head>'
+        f"<body><header>ヘッダー</header><nav>メニュー</nav><main>{body}</main>"
+        f'<div class="ads">広告</div><footer>フッター</footer></body></html>'
+    )
+
+def render_image(n: int, width: int = 480, height: int = 160) -> bytes:
+    # OCRで読める英字を描いたPNG
+    img = Image.new("RGB", (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    rng = random.Random(f"img-{n}")
+    for line in range(4):
+        draw.text((10, 10 + line * 36), _sentence(rng, EN_WORDS, " ", 6).upper(), fill=(0, 0, 0))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def build_page(kind: str, n: int) -> tuple[int, str]:
+    # (ステータス, HTML)
+    rng = random.Random(f"{kind}-{n}")
+    if kind == "short-ja":
+        return 200, _page(f"短いページ{n}", _paragraphs(rng, JA_WORDS, "", 3))
+    if kind == "short-en":
+        return 200, _page(f"Short page {n}", _paragraphs(rng, EN_WORDS, " ", 3), lang="en")
+    if kind == "long-ja":
+        return 200, _page(f"長いページ{n}", _paragraphs(rng, JA_WORDS, "", 200))
+    if kind == "infinite-scroll":
+        # スクロールするたびに段落を追加（10回まで）
+        script = (
+            "<script>let added=0;window.addEventListener('scroll',()=>{"
+            "if(added>=10||window.innerHeight+window.scrollY<document.body.scrollHeight-50)return;"
+            "added++;const m=document.querySelector('main');"
+            "for(let i=0;i<20;i++){const p=document.createElement('p');"
+            "p.textContent='追加コンテンツ '+added+'-'+i;m.appendChild(p);}});</script>"
+        )
+        return 200, _page(f"無限スクロール{n}", _paragraphs(rng, JA_WORDS, "", 30) + script)
+    if kind == "image-heavy":
+        images = "".join(f'<img src="/img/{n * 100 + i}.png" alt="画像{i}" width="480" height="160">' for i in range(20))
+        return 200, _page(f"画像の多いページ{n}", _paragraphs(rng, JA_WORDS, "", 2) + images)
+    if kind == "forbidden":
+        return 403, _page("403 Forbidden", "<h1>アクセスが拒否されました</h1>")
+    return 404, _page("404 Not Found", "<h1>ページが見つかりません</h1>")
+
+def corpus_urls(base_url: str, per_kind: int) -> list:
+    return [f"{base_url}/page/{kind}/{n}" for n in range(per_kind) for kind in KINDS]
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "img" and parts[1].endswith(".png") and parts[1][:-4].isdigit():
+            self._send(200, "image/png", render_image(int(parts[1][:-4])))
+        elif len(parts) == 3 and parts[0] == "page" and parts[1] in KINDS and parts[2].isdigit():
+            status, html = build_page(parts[1], int(parts[2]))
+            self._send(status, "text/html; charset=utf-8", html.encode("utf-8"))
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_fixture_server(host: str = "127.0.0.1", port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,330 @@
+# オフラインのベンチマーク（外部サービスには一切つながない）
+# フィクスチャページをローカルHTTPサーバーで配信し、OpenAI / Drive / Sheets は遅延を指定できるスタンドインに置き換えて
+# URL/分、段階ごとの p50/p95、ベンチマークごとのピークRSS（子プロセス込み）を測り、コミットハッシュ付きの JSON に保存する
+# 例: python bench/run_bench.py --per-kind 3
+#     python bench/run_bench.py --compare bench/results/abc1234.json
+# Chrome や tesseract が無い環境では、それを使うベンチマークは skipped になる
+import argparse, json, os, platform, resource, shutil, subprocess, sys, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fixtures import BENCH_RULES, KINDS, build_page, corpus_urls, render_image, start_fixture_server
+from fakes import FakeDriveService, FakeWorksheet, start_fake_openai
+
+
+def summarize(latencies: list, seconds: float, errors: int = 0, peak_rss: float = 0.0) -> dict:
+    from web_unsafe_list import percentile  # アプリは main で環境変数を設定してから import する
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "per_minute": round(len(latencies) / seconds * 60, 1) if seconds > 0 else 0.0,
+        "p50": round(percentile(latencies, 0.5), 4),
+        "p95": round(percentile(latencies, 0.95), 4),
+        "peak_rss_mb": peak_rss,
+    }
+
+def timed(fn, inputs) -> dict:
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        for value in inputs:
+            t = time.perf_counter()
+            try:
+                fn(value)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - started, errors, rss.peak_mb)
+
+def peak_rss_mb() -> float:
+    # Linux の ru_maxrss は KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def child_pids(pid) -> list:
+    pids = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            pids.extend(f.read().split())
+    return pids
+
+def tree_rss_kb() -> int:
+    # 自分と子孫プロセス（OCRプールの spawn 子プロセスなど）の今のRSSの合計
+    total_kb, pending = 0, ["self"]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+            pending.extend(child_pids(pid))
+        except OSError:
+            pass  # 測っている間に終了したプロセス
+    return total_kb
+
+class RssSampler:
+    # ベンチマーク1つの間だけ、自分と子プロセスのRSSの合計を一定間隔で測って最大値を取る
+    # ru_maxrss はプロセス起動からの最大値で、前のベンチマークの分も子プロセスの分も区別できないため
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak_kb = max(self.peak_kb, tree_rss_kb())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, tree_rss_kb())
+
+    @property
+    def peak_mb(self) -> float:
+        if not os.path.isdir("/proc/self"):
+            return peak_rss_mb()  # /proc が無い環境ではプロセス全体の最大値で代用
+        return round(self.peak_kb / 1024, 1)
+
+def children_peak_rss_mb() -> float:
+    # OCRプールなど生きている子プロセスのピークRSSの合計（/proc が無ければ 0）
+    total_kb = 0
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                for pid in f.read().split():
+                    with open(f"/proc/{pid}/status") as status:
+                        for line in status:
+                            if line.startswith("VmHWM:"):
+                                total_kb += int(line.split()[1])
+    except OSError:
+        pass
+    return round(total_kb / 1024, 1)
+
+def git_info() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, timeout=30).stdout.strip()
+        except Exception:
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def chrome_available() -> bool:
+    return any(shutil.which(name) for name in ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser"))
+
+def install_fakes(app, urls: list, args) -> dict:
+    worksheet = FakeWorksheet(urls, args.sheets_latency)
+    drive = FakeDriveService(args.drive_latency)
+    app.get_worksheet = lambda: worksheet
+    app.get_drive_service = lambda: drive
+    app.DriveUploader._service = lambda self: drive
+    store = app.RuleStore()
+    store.rules = app.GenreRules(**BENCH_RULES)
+    app.get_rule_store = lambda: store
+    return {"worksheet": worksheet, "drive": drive}
+
+def bench_judges(app, per_kind: int) -> dict:
+    pages = [(f"http://bench.example.jp/page/{kind}/{n}", build_page(kind, n)[1]) for n in range(per_kind) for kind in KINDS]
+    docs = [(url, app.PageDocument(html)) for url, html in pages]
+    texts = [doc.clean_text for _, doc in docs]
+    captures = [app.Capture(render_image(n), f"bench_{n}.png") for n in range(per_kind * 2)]
+    matcher = app.current_rules().matcher
+    app.get_gpt_client().reset_dedupe()
+    return {
+        "judge_keywords_by_count": timed(lambda text: app.judge_keywords_by_count(text, matcher), texts),
+        "judge_genre_by_patterns": timed(lambda page: app.judge_genre_by_patterns([page[0]], matcher), pages),
+        "is_japanese_site_by_html_or_ocr": timed(lambda doc: app.is_japanese_site_by_html_or_ocr(doc[0], doc[1], ""), docs),
+        "gpt_judge_genre": timed(lambda text: app.gpt_judge_genre(text, "", None), texts),
+        "gpt_judge_image": timed(lambda capture: app.gpt_judge_image(capture, ""), captures),
+    }
+
+def bench_ocr(app, per_kind: int) -> dict:
+    from PIL import Image
+    import io
+    images = [render_image(n) for n in range(per_kind * 2)]
+    # 縦長のスクショ相当（帯に分けて並列OCRされる）
+    tall = Image.new("RGB", (480, 160 * 25), (255, 255, 255))
+    for i in range(25):
+        with Image.open(io.BytesIO(render_image(1000 + i))) as tile:
+            tall.paste(tile, (0, i * 160))
+    buf = io.BytesIO()
+    tall.save(buf, format="PNG")
+    app.collect_ocr(app.submit_ocr(images[0]))  # プールの起動はここで済ませる
+    return {
+        "extract_image_ocr_text": timed(app.extract_image_ocr_text, images),
+        "extract_image_ocr_text_tall": timed(app.extract_image_ocr_text, [buf.getvalue()] * max(1, per_kind)),
+    }
+
+def bench_crawl(app, urls: list) -> dict:
+    return {"crawl_with_ocr": timed(lambda pair: app.crawl_with_ocr(pair[1], pair[0]), list(enumerate(urls, 1)))}
+
+def bench_writeback(app, fakes: dict, count: int) -> dict:
+    urls = [row[0] for row in fakes["worksheet"].rows][:count]
+    items = [
+        {
+            "idx": idx, "url": url, "timings": {},
+            "capture": app.Capture(render_image(idx), f"screenshot_{idx}.png"),
+            "maintext": "ベンチマーク本文", "image_desc": "", "ocr_text": "", "doc": None,
+            "gpt_opinion": "[ジャンル]: カテゴリー該当なし", "gpt_image_opinion": "[ジャンル]: 要確認 / [理由]: なし",
+        }
+        for idx, url in enumerate(urls, 1)
+    ]
+    writer = app.SheetWriter(fakes["worksheet"])
+    uploader = app.DriveUploader()
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        result = timed(lambda item: app.stage_io(item, writer, None, uploader), items)
+        flush_started = time.perf_counter()
+        uploader.close()
+        writer.close()
+        flush_seconds = time.perf_counter() - flush_started
+    total = time.perf_counter() - started
+    result.update(
+        peak_rss_mb=rss.peak_mb,
+        flush_seconds=round(flush_seconds, 3),
+        per_minute=round(len(items) / total * 60, 1) if total > 0 else 0.0,
+        sheet_calls=fakes["worksheet"].calls,
+        drive_uploads=fakes["drive"].uploads,
+    )
+    return {"writeback": result}
+
+def bench_pipeline(app, fakes: dict, urls: list) -> dict:
+    recorder = app.SpanRecorder()
+    writer = app.SheetWriter(fakes["worksheet"], recorder=recorder)
+    uploader = app.DriveUploader()
+    workers = app.load_pipeline_workers()
+    pipeline = app.UrlPipeline(app.build_pipeline_stages(writer, None, uploader), workers, recorder=recorder)
+    items = [{"idx": idx, "url": url, "readiness": app.READINESS_PROFILE, "timings": {}} for idx, url in enumerate(urls, 1)]
+    started = time.perf_counter()
+    done, errors, stage_latencies = [], 0, {}
+    with RssSampler() as rss:
+        for item in pipeline.run(items):
+            errors += bool(item.get("error"))
+            for name, seconds in item["timings"].items():
+                stage_latencies.setdefault(name, []).append(seconds)
+            app.cleanup_item(item)
+            done.append(time.perf_counter() - started)
+        uploader.close()
+        writer.close()
+    result = summarize(done, time.perf_counter() - started, errors, rss.peak_mb)
+    del result["p50"], result["p95"]  # 完了時刻の分布は意味が無いので段階ごとの値だけ残す
+    result["workers"] = workers
+    result["stages"] = {
+        name: {"p50": round(app.percentile(values, 0.5), 4), "p95": round(app.percentile(values, 0.95), 4)}
+        for name, values in stage_latencies.items()
+    }
+    metrics = json.loads(recorder.to_json())
+    result["spans"] = metrics["spans"]
+    result["counters"] = metrics["counters"]  # gpt_deduped など
+    return {"pipeline": result}
+
+def print_report(report: dict, baseline: "dict | None" = None):
+    print(f"commit {report['git']['commit'][:12]}{' (dirty)' if report['git']['dirty'] else ''}  peak RSS {report['peak_rss_mb']} MB"
+          f" (+子プロセス {report['children_peak_rss_mb']} MB)")
+    for name, result in report["benchmarks"].items():
+        if not isinstance(result, dict):
+            continue
+        if result.get("skipped"):
+            print(f"  {name:36s} skipped: {result['skipped']}")
+            continue
+        line = f"  {name:36s} {result['per_minute']:>9.1f}/分  p50 {result.get('p50', 0):.4f}s  p95 {result.get('p95', 0):.4f}s  RSS {result.get('peak_rss_mb', 0)} MB  errors {result['errors']}"
+        old = (baseline or {}).get("benchmarks", {}).get(name)
+        if isinstance(old, dict) and old.get("per_minute"):
+            line += f"  (前回比 {(result['per_minute'] / old['per_minute'] - 1) * 100:+.1f}%)"
+        print(line)
+        for stage, values in result.get("stages", {}).items():
+            print(f"      {stage:32s} p50 {values['p50']:.4f}s  p95 {values['p95']:.4f}s")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="フィクスチャとスタンドインを使ったオフラインのベンチマーク")
+    parser.add_argument("--per-kind", type=int, default=3, help=f"ページ種別（{', '.join(KINDS)}）ごとのURL数")
+    parser.add_argument("--gpt-latency", type=float, default=0.8, help="OpenAI スタンドインの応答遅延（秒）")
+    parser.add_argument("--drive-latency", type=float, default=0.3, help="Drive スタンドインの応答遅延（秒）")
+    parser.add_argument("--sheets-latency", type=float, default=0.5, help="Sheets スタンドインの応答遅延（秒）")
+    parser.add_argument("--writeback-count", type=int, default=50, help="書き込みベンチマークの件数")
+    parser.add_argument("--only", nargs="*", choices=["judges", "ocr", "crawl", "writeback", "pipeline"], help="実行するベンチマーク")
+    parser.add_argument("--output", help="結果の JSON（省略時は bench/results/<コミット>.json）")
+    parser.add_argument("--compare", help="比較対象の結果 JSON")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    only = set(args.only or ["judges", "ocr", "crawl", "writeback", "pipeline"])
+
+    _, fixture_url = start_fixture_server()
+    _, openai_url = start_fake_openai(args.gpt_latency)
+    # アプリは import 時に環境変数を読むので、先にスタンドインへ向けておく
+    os.environ.update({
+        "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": openai_url,
+        "SPREADSHEET_ID": "bench", "SHEET_NAME": "bench", "DRIVE_FOLDER_ID": "bench", "SERVICE_ACCOUNT_JSON": "{}",
+    })
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")
+    import web_unsafe_list as app
+
+    urls = corpus_urls(fixture_url, args.per_kind)
+    sheet_urls = urls + [f"{fixture_url}/writeback/{i}" for i in range(args.writeback_count)]
+    fakes = install_fakes(app, sheet_urls, args)
+    has_chrome, has_tesseract = chrome_available(), bool(shutil.which("tesseract"))
+
+    benchmarks = {}
+    if "judges" in only:
+        benchmarks.update(bench_judges(app, args.per_kind))
+    if "ocr" in only:
+        if has_tesseract:
+            benchmarks.update(bench_ocr(app, args.per_kind))
+        else:
+            benchmarks["extract_image_ocr_text"] = {"skipped": "tesseract が見つかりません"}
+    if "crawl" in only:
+        if has_chrome:
+            benchmarks.update(bench_crawl(app, urls))
+        else:
+            benchmarks["crawl_with_ocr"] = {"skipped": "Chrome が見つかりません"}
+    if "writeback" in only:
+        fakes["worksheet"].rows = [[url] for url in sheet_urls[len(urls):]]
+        benchmarks.update(bench_writeback(app, fakes, args.writeback_count))
+        fakes["worksheet"].rows = [[url] for url in sheet_urls]
+    if "pipeline" in only:
+        if has_chrome:
+            benchmarks.update(bench_pipeline(app, fakes, urls))
+        else:
+            benchmarks["pipeline"] = {"skipped": "Chrome が見つかりません"}
+
+    report = {
+        "git": git_info(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "per_kind": args.per_kind, "urls": len(urls),
+            "gpt_latency": args.gpt_latency, "drive_latency": args.drive_latency, "sheets_latency": args.sheets_latency,
+            "ocr_mode": app.OCR_MODE, "capture_mode": app.CAPTURE_MODE, "readiness": app.READINESS_PROFILE,
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "children_peak_rss_mb": children_peak_rss_mb(),
+        "benchmarks": benchmarks,
+    }
+    output = args.output or os.path.join(ROOT, "bench", "results", f"{report['git']['commit'][:12] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"結果: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
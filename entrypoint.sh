@@ -1,2 +1,10 @@
 #!/bin/bash
-streamlit run web_unsafe_list.py --server.port=${PORT:-7860} --server.address=0.0.0.0
+# MODE=ui（既定）: Streamlit UI / MODE=batch: batch_cli.py（引数はそのまま渡す）
+case "${MODE:-ui}" in
+  batch)
+    exec python batch_cli.py "$@"
+    ;;
+  *)
+    exec streamlit run web_unsafe_list.py --server.port=${PORT:-7860} --server.address=0.0.0.0
+    ;;
+esac
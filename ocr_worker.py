@@ -0,0 +1,45 @@
+# OCRワーカー
+# プロセスプールの子プロセスから呼ばれるため、Streamlit やアプリ本体には依存させない
+import io, time
+from PIL import Image
+
+OCR_LANG = "jpn+eng"
+
+def band_boxes(width: int, height: int, band_height: int, overlap: int, max_height: int = 0) -> list:
+    # 縦長画像を、境目の行が切れないよう少し重ねた横長の帯に分ける
+    if max_height:
+        height = min(height, max_height)
+    band_height = max(band_height, overlap + 1)
+    boxes = []
+    top = 0
+    while top < height:
+        bottom = min(top + band_height, height)
+        boxes.append((0, top, width, bottom))
+        if bottom >= height:
+            break
+        top = bottom - overlap
+    return boxes
+
+def ocr_band(png_bytes: bytes, box=None, lang: str = OCR_LANG) -> tuple[str, float]:
+    import pytesseract  # 重いので子プロセスで最初に使う時に読み込む
+    started = time.time()
+    try:
+        with Image.open(io.BytesIO(png_bytes)) as img:
+            if box:
+                img = img.crop(box)
+            text = pytesseract.image_to_string(img, lang=lang).strip()
+    except Exception:
+        text = ""
+    return text, time.time() - started
+
+def merge_band_texts(texts, max_overlap_lines: int = 3) -> str:
+    # 重なり部分で二重に読まれた行を取り除きながら上から順に連結
+    merged = []
+    for text in texts:
+        lines = [line for line in text.splitlines() if line.strip()]
+        for k in range(min(max_overlap_lines, len(merged), len(lines)), 0, -1):
+            if merged[-k:] == lines[:k]:
+                lines = lines[k:]
+                break
+        merged.extend(lines)
+    return "\n".join(merged)
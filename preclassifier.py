@@ -0,0 +1,209 @@
+# 事前分類器（fugashi の形態素をハッシュした bag-of-words ＋ 線形モデル）
+# シートの R列（本文）と Y列（ジャンル）から学習し、確信度が閾値以上のページは GPT の本文判定を省く
+# 例: python preclassifier.py train export.csv --target-accuracy 0.95
+#     python preclassifier.py evaluate export2.csv
+# export.csv はシートを「ファイル > ダウンロード > CSV」で書き出したもの
+import argparse, csv, sys, threading, zlib
+import numpy as np
+
+MODEL_PATH = "preclassifier.npz"
+FEATURE_DIM = 2 ** 18
+NO_GENRE = "カテゴリー該当なし"
+# Y列の文字列から最初に出てくるものをラベルにする（GPTの補足や理由が付いていてもよい）
+GENRES = ["アダルト", "悪質CGM", "著作権侵害", "ポイント", "ヘイト", "危険物", "グロテスク", "ネガティブ", "閲覧不可", "認証が必要", "海外サイト"]
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99]
+
+_tagger = None
+
+def tokenize(text: str) -> list:
+    # アプリからは get_words を渡すので、これは CLI で学習する時だけ使う
+    global _tagger
+    if _tagger is None:
+        from fugashi import Tagger
+        _tagger = Tagger()
+    return [word.surface for word in _tagger(text)] if text else []
+
+def label_of(genre_text: str) -> str:
+    found = [(genre_text.find(g), g) for g in GENRES if g in genre_text]
+    return min(found)[1] if found else NO_GENRE
+
+def featurize(tokens: list, dim: int = FEATURE_DIM) -> tuple:
+    # 1語と隣接2語を crc32 で dim 次元に落とす（Python の hash() は起動ごとに変わるので使わない）
+    words = [t.lower() for t in tokens if t.strip()]
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not grams:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    idx = np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) % dim for g in grams), dtype=np.int64, count=len(grams)))
+    val = np.full(len(idx), 1.0 / np.sqrt(len(idx)), dtype=np.float32)
+    return idx, val
+
+def softmax(z: np.ndarray) -> np.ndarray:
+    z = np.exp(z - z.max())
+    return z / z.sum()
+
+class PreClassifier:
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, classes: list, threshold: float = 1.0, tokenize=tokenize):
+        self.weights = weights
+        self.bias = bias
+        self.classes = list(classes)
+        self.threshold = threshold  # これ未満の確信度は GPT に回す（1.0 なら常に回す）
+        self.tokenize = tokenize
+        self._lock = threading.Lock()  # MeCab のタガーは同時に呼べない
+
+    @property
+    def dim(self) -> int:
+        return self.weights.shape[0]
+
+    def proba(self, features: tuple) -> np.ndarray:
+        idx, val = features
+        return softmax(val @ self.weights[idx] + self.bias)
+
+    def predict(self, text: str) -> tuple[str, float]:
+        with self._lock:
+            tokens = self.tokenize(text)
+        p = self.proba(featurize(tokens, self.dim))
+        best = int(p.argmax())
+        return self.classes[best], float(p[best])
+
+    @classmethod
+    def train(cls, features: list, labels: list, dim: int = FEATURE_DIM, epochs: int = 8, lr: float = 0.5, seed: int = 0) -> "PreClassifier":
+        # 多クラスのロジスティック回帰を SGD で（特徴は疎なので触った行だけ更新する）
+        classes = sorted(set(labels))
+        y = np.array([classes.index(label) for label in labels])
+        weights = np.zeros((dim, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        model = cls(weights, bias, classes)
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            step = lr / (1 + epoch)
+            for i in rng.permutation(len(features)):
+                idx, val = features[i]
+                grad = model.proba(features[i])
+                grad[y[i]] -= 1
+                weights[idx] -= step * np.outer(val, grad)
+                bias -= step * grad
+        return model
+
+    def save(self, path: str = MODEL_PATH):
+        np.savez_compressed(
+            path, weights=self.weights, bias=self.bias,
+            classes=np.array(self.classes), threshold=np.array(self.threshold),
+        )
+
+    @classmethod
+    def load(cls, path: str = MODEL_PATH, tokenize=tokenize) -> "PreClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["weights"], data["bias"], [str(c) for c in data["classes"]], float(data["threshold"]), tokenize)
+
+def column_index(letter: str) -> int:
+    # "R" -> 17（0始まり）
+    index = 0
+    for ch in letter.upper():
+        index = index * 26 + ord(ch) - ord("A") + 1
+    return index - 1
+
+def read_rows(path: str, text_col: str = "R", label_col: str = "Y", gpt_col: str = "T") -> list:
+    # 段階判定・事前分類・近似重複で決まった行（T列が GPT未実行 / 事前分類 / 近似重複）は学習に使わない
+    # 近似重複の行は流用元と同じ判定のコピーなので、学習に入れると評価用の行にも漏れて正解率が高く出る
+    text_i, label_i, gpt_i = column_index(text_col), column_index(label_col), column_index(gpt_col)
+    rows = []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            if len(row) <= max(text_i, label_i):
+                continue
+            text, genre = row[text_i].strip(), row[label_i].strip()
+            gpt = row[gpt_i] if len(row) > gpt_i else ""
+            if not text or not genre or any(marker in gpt for marker in ("GPT未実行", "事前分類", "近似重複")):
+                continue
+            rows.append((text, label_of(genre)))
+    return rows
+
+def is_holdout(text: str, percent: int) -> bool:
+    # 評価用に取り分ける行（本文のハッシュで決めるので毎回同じ行になる）
+    return zlib.crc32(text.encode("utf-8")) % 100 < percent
+
+def coverage_table(model: PreClassifier, features: list, labels: list) -> list:
+    # 閾値ごとに、GPTを省ける割合と、省いた分の正解率
+    predictions = []
+    for f in features:
+        p = model.proba(f)
+        best = int(p.argmax())
+        predictions.append((model.classes[best], float(p[best])))
+    table = []
+    for threshold in THRESHOLDS:
+        covered = [(label, pred) for (pred, prob), label in zip(predictions, labels) if prob >= threshold]
+        correct = sum(1 for label, pred in covered if label == pred)
+        table.append({
+            "threshold": threshold,
+            "saved": len(covered),
+            "total": len(labels),
+            "accuracy": correct / len(covered) if covered else 0.0,
+        })
+    return table
+
+def pick_threshold(table: list, target_accuracy: float) -> float:
+    # 目標の正解率を満たす一番低い閾値（満たすものが無ければ 1.0 = 常に GPT）
+    for row in table:
+        if row["saved"] and row["accuracy"] >= target_accuracy:
+            return row["threshold"]
+    return 1.0
+
+def print_table(table: list, chosen: float):
+    print("閾値   GPT省略         省略分の正解率", file=sys.stderr)
+    for row in table:
+        mark = " ←" if row["threshold"] == chosen else ""
+        share = row["saved"] / row["total"] if row["total"] else 0.0
+        accuracy = f"{row['accuracy']:6.1%}" if row["saved"] else "     -"
+        print(f"{row['threshold']:.2f}   {row['saved']:>5}/{row['total']:<5} ({share:6.1%})   {accuracy}{mark}", file=sys.stderr)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="GPT本文判定の前に使う事前分類器の学習・評価")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("train", "evaluate"):
+        p = sub.add_parser(name)
+        p.add_argument("csv", help="シートを書き出した CSV")
+        p.add_argument("--model", default=MODEL_PATH)
+        p.add_argument("--text-col", default="R")
+        p.add_argument("--label-col", default="Y")
+        p.add_argument("--target-accuracy", type=float, default=0.95, help="GPTを省いた分で満たしたい正解率")
+    train_parser = sub.choices["train"]
+    train_parser.add_argument("--holdout", type=int, default=20, help="評価に取り分ける割合（%%）")
+    train_parser.add_argument("--epochs", type=int, default=8)
+    train_parser.add_argument("--dim", type=int, default=FEATURE_DIM)
+    args = parser.parse_args(argv)
+
+    rows = read_rows(args.csv, args.text_col, args.label_col)
+    if not rows:
+        print(f"❌ 学習・評価に使える行がありません: {args.csv}", file=sys.stderr)
+        return 2
+
+    if args.command == "train":
+        train_rows = [r for r in rows if not is_holdout(r[0], args.holdout)]
+        test_rows = [r for r in rows if is_holdout(r[0], args.holdout)] or train_rows
+        if len({label for _, label in train_rows}) < 2:
+            print("❌ ジャンルが1種類しかないので学習できません。", file=sys.stderr)
+            return 2
+        model = PreClassifier.train([featurize(tokenize(t), args.dim) for t, _ in train_rows], [l for _, l in train_rows], args.dim, args.epochs)
+        print(f"学習 {len(train_rows)}行 / 評価 {len(test_rows)}行 / ジャンル: {', '.join(model.classes)}", file=sys.stderr)
+    else:
+        model = PreClassifier.load(args.model)
+        test_rows = rows
+
+    table = coverage_table(model, [featurize(tokenize(t), model.dim) for t, _ in test_rows], [l for _, l in test_rows])
+    threshold = pick_threshold(table, args.target_accuracy)
+    print_table(table, threshold)
+    chosen = next((row for row in table if row["threshold"] == threshold), None)
+    if chosen:
+        print(f"正解率 {args.target_accuracy:.0%} 以上で GPT本文判定を {chosen['saved']}/{chosen['total']}件（{chosen['saved'] / chosen['total']:.1%}）省けます（閾値 {threshold:.2f}）。", file=sys.stderr)
+    else:
+        print(f"正解率 {args.target_accuracy:.0%} を満たす閾値がありません（全件 GPT に回します）。", file=sys.stderr)
+
+    if args.command == "train":
+        model.threshold = threshold
+        model.save(args.model)
+        print(f"モデルを {args.model} に保存しました。", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
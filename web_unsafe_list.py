@@ -1,19 +1,19 @@
-import os, re, time, datetime, requests, base64, io
+import time
+STARTUP_STARTED = time.perf_counter()  # 起動時間の計測用（Streamlit の再実行ごとにも測る）
+
+import os, re, datetime, requests, base64, io, math
+import hashlib, sqlite3, asyncio
+import atexit, multiprocessing, queue, random, socket, threading, uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import streamlit as st
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.oauth2.service_account import Credentials
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+from functools import cached_property
+from urllib.parse import parse_qsl, urlparse
+# selenium / googleapiclient / gspread / openai / fugashi は重いので、使う関数の中で import する
 from PIL import Image
-import pytesseract
-import gspread
-import openai
-from fugashi import Tagger
+import ocr_worker
 import json
 
 # Google認証とAPIキー
@@ -24,35 +24,44 @@ DRIVE_FOLDER_ID = os.getenv("DRIVE_FOLDER_ID")
 GPT_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # ✅ 필수 환경변수 체크
-missing_vars = []
-for var_name in ["SERVICE_ACCOUNT_JSON", "SPREADSHEET_ID", "SHEET_NAME", "DRIVE_FOLDER_ID", "OPENAI_API_KEY"]:
-    if not os.getenv(var_name):
-        missing_vars.append(var_name)
-if missing_vars:
-    st.error(f"❌ 次の変数が設定されてません。: {', '.join(missing_vars)}")
-    st.stop()
-
-# ✅ 인증 처리
-try:
-    service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
-except Exception:
-    st.error("❌ SERVICE_ACCOUNT_JSON が有効なJSONではありません。")
-    st.stop()
-
-creds = Credentials.from_service_account_info(
-    service_account_info,
-    scopes=[
-        "https://www.googleapis.com/auth/drive",
-        "https://www.googleapis.com/auth/spreadsheets"
-    ]
-)
+REQUIRED_ENV_VARS = ["SERVICE_ACCOUNT_JSON", "SPREADSHEET_ID", "SHEET_NAME", "DRIVE_FOLDER_ID", "OPENAI_API_KEY"]
+
+def missing_env_vars() -> list:
+    return [var_name for var_name in REQUIRED_ENV_VARS if not os.getenv(var_name)]
+
+# ✅ 인증 처리（クライアントはプロセスで1回だけ作る）
+@st.cache_resource
+def get_credentials():
+    from google.oauth2.service_account import Credentials
+    try:
+        service_account_info = json.loads(SERVICE_ACCOUNT_JSON)
+    except Exception:
+        raise ValueError("SERVICE_ACCOUNT_JSON が有効なJSONではありません。")
+    return Credentials.from_service_account_info(
+        service_account_info,
+        scopes=[
+            "https://www.googleapis.com/auth/drive",
+            "https://www.googleapis.com/auth/spreadsheets"
+        ]
+    )
 
-gc = gspread.authorize(creds)
-drive_service = build('drive', 'v3', credentials=creds)
-worksheet = gc.open_by_key(SPREADSHEET_ID).worksheet(SHEET_NAME)
+@st.cache_resource
+def get_gspread_client():
+    import gspread
+    return gspread.authorize(get_credentials())
 
-# ✅ OpenAI 설정
-openai.api_key = GPT_API_KEY
+@st.cache_resource
+def get_drive_service():
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', credentials=get_credentials())
+
+@st.cache_resource
+def get_spreadsheet():
+    return get_gspread_client().open_by_key(SPREADSHEET_ID)
+
+@st.cache_resource
+def get_worksheet():
+    return get_spreadsheet().worksheet(SHEET_NAME)
 
 @st.cache_resource
 def validate_openai_key(api_key):
@@ -65,9 +74,17 @@ def validate_openai_key(api_key):
     except Exception:
         return False
 
+def read_rule_rows(sheet_name: str) -> list:
+    # values_get 1回で読む。get_all_values と同じく行の長さを揃える
+    rows = get_spreadsheet().values_get(f"'{sheet_name}'").get("values", [])
+    width = max((len(row) for row in rows), default=0)
+    return [row + [""] * (width - len(row)) for row in rows]
+
 def load_rules_from_sheet(sheet_name: str):
-    worksheet = gc.open_by_key(SPREADSHEET_ID).worksheet(sheet_name)
-    rows = worksheet.get_all_values()[1:] 
+    return parse_rule_rows(read_rule_rows(sheet_name))
+
+def parse_rule_rows(rows: list):
+    rows = rows[1:]
 
     genre_keywords = {}
     url_patterns = {}
@@ -96,10 +113,13 @@ def load_rules_from_sheet(sheet_name: str):
     return genre_keywords, url_patterns, japanese_domains
 
 # OCR + クリーン本文抽出
-tagger = Tagger()
+@st.cache_resource
+def get_tagger():
+    from fugashi import Tagger
+    return Tagger()
 
 def get_words(text):
-    return [word.surface for word in tagger(text)] if text else []
+    return [word.surface for word in get_tagger()(text)] if text else []
 
 def extract_domain(url):
     try:
@@ -107,153 +127,959 @@ def extract_domain(url):
     except:
         return ""
 
-def fetch_with_retry(url, timeout=10, retries=1):
-    for attempt in range(retries + 1):
+def normalize_url(url: str) -> str:
+    # 同じページを1回だけ処理するための正規化（スキーム・ホストの小文字化、既定ポートと # 以降の除去）
+    url = (url or "").strip()
+    try:
+        parts = urlparse(url)
+    except ValueError:
+        return url
+    if parts.scheme.lower() not in ("http", "https") or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return parts._replace(scheme=scheme, netloc=netloc, path=parts.path or "/", fragment="").geturl()
+
+def dedupe_urls(urls) -> list:
+    # 正規化して重複を除く（順番は最初に出てきた位置）
+    return list(dict.fromkeys(normalize_url(url) for url in urls if url and url.strip()))
+
+# HTTP取得（接続を使い回し、ホストごとに同時リクエスト数と間隔を制限する）
+FETCH_POOL_SIZE = int(os.getenv("FETCH_POOL_SIZE", "16"))  # 1ホストあたりに保持する接続数
+FETCH_POOL_HOSTS = int(os.getenv("FETCH_POOL_HOSTS", "64"))  # 接続を保持しておくホスト数
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", "2"))  # 同じホストへの同時リクエスト数（ブラウザの読み込みも含む）
+FETCH_HOST_DELAY = float(os.getenv("FETCH_HOST_DELAY", "0"))  # 同じホストへのリクエスト開始間隔（秒）
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "0"))
+FETCH_HTTP2 = os.getenv("FETCH_HTTP2", "0") == "1"  # httpx[http2] が入っていれば HTTP/2 で取得
+
+class HostLimiter:
+    def __init__(self, per_host: int = FETCH_PER_HOST, delay: float = FETCH_HOST_DELAY):
+        self.per_host = max(1, per_host)
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._hosts = {}  # host -> {"active": 実行中の数, "next": 次に開始してよい時刻}
+
+    @contextmanager
+    def slot(self, url: str):
+        host = extract_domain(url)
+        with self._cond:
+            while True:
+                # 待っている間に掃除されることがあるので毎回引き直す
+                state = self._hosts.setdefault(host, {"active": 0, "next": 0.0})
+                if state["active"] < self.per_host:
+                    break
+                self._cond.wait()
+            state["active"] += 1
+            now = time.time()
+            start = max(now, state["next"])
+            state["next"] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
         try:
-            resp = requests.get(url, timeout=timeout)
-            resp.encoding = resp.apparent_encoding
-            return resp
-        except requests.exceptions.RequestException:
-            if attempt < retries:
-                time.sleep(1)
-    return None
+            yield
+        finally:
+            with self._cond:
+                state["active"] -= 1
+                if state["active"] == 0 and state["next"] <= time.time():
+                    self._hosts.pop(host, None)
+                self._cond.notify_all()
+
+class FetchResult:
+    def __init__(self, url: str, status_code: int, text: str):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+
+class HttpFetcher:
+    def __init__(self, pool_size: int = FETCH_POOL_SIZE, pool_hosts: int = FETCH_POOL_HOSTS, http2: bool = FETCH_HTTP2):
+        self.limiter = HostLimiter()
+        self._client = None
+        if http2:
+            try:
+                import httpx
+                import h2  # noqa: F401
+                self._client = httpx.Client(
+                    http2=True,
+                    follow_redirects=True,
+                    limits=httpx.Limits(max_connections=pool_size * pool_hosts, max_keepalive_connections=pool_size * 4),
+                )
+            except ImportError:
+                pass  # 入っていなければ requests で取得
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _get(self, url: str, timeout: float) -> FetchResult:
+        if self._client is not None:
+            resp = self._client.get(url, timeout=timeout)
+            # requests の apparent_encoding と同じく中身から文字コードを推定する
+            encoding = requests.compat.chardet.detect(resp.content)["encoding"] or "utf-8"
+            return FetchResult(str(resp.url), resp.status_code, resp.content.decode(encoding, errors="replace"))
+        resp = self._session.get(url, timeout=timeout)
+        resp.encoding = resp.apparent_encoding
+        return FetchResult(resp.url, resp.status_code, resp.text)
+
+    def get(self, url: str, timeout: float = 10, retries: int = FETCH_RETRIES) -> "FetchResult | None":
+        for attempt in range(retries + 1):
+            try:
+                with self.limiter.slot(url):
+                    return self._get(url, timeout)
+            except Exception:
+                if attempt < retries:
+                    time.sleep(1)
+        return None
 
-def extract_clean_text(html: str) -> str:
-    soup = BeautifulSoup(html, "html.parser")
-    ad_selectors = [
-        'header', 'footer', 'nav', 'iframe', 'ins',
-        '.footer', '.header', '.ads', '.sponsor', '.promo', '.widget',
-        '[id*="ad"]', '[class*="ad"]', '[class*="sponsor"]', '[id*="sponsor"]',
-        '[class*="banner"]', '[id*="banner"]', '[class*="rec"]', '[class*="promo"]'
-    ]
-    for selector in ad_selectors:
-        for tag in soup.select(selector):
-            tag.decompose()
+@st.cache_resource
+def get_http_fetcher() -> HttpFetcher:
+    return HttpFetcher()
 
-    for tag in soup(["script", "style"]):
-        tag.decompose()
+def fetch_with_retry(url, timeout=10, retries=1):
+    return get_http_fetcher().get(url, timeout=timeout, retries=retries)
+
+# 区間ごとの所要時間の計測（URLごとに記録し、実行後に表・JSON・Prometheus 形式で出す）
+# パイプラインのワーカーが span_context で「今どのURLを処理中か」をスレッドに持たせ、各処理は span(...) で囲むだけにする
+_span_local = threading.local()
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest-rank（q*n 以上の最小の順位）
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+class SpanRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}  # span -> [秒]
+        self.errors = {}  # span -> 件数
+        self.by_url = {}  # url -> {span: 秒}
+        self.url_errors = {}  # url -> [span]
+        self.counters = {}  # 区間ではない出来事の件数（例: gpt_deduped）
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name: str, seconds: float, url: "str | None" = None, error: bool = False):
+        with self._lock:
+            self.durations.setdefault(name, []).append(seconds)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if url is not None:
+                spans = self.by_url.setdefault(url, {})
+                spans[name] = spans.get(name, 0.0) + seconds
+                if error:
+                    self.url_errors.setdefault(url, []).append(name)
+
+    def summary(self) -> list:
+        with self._lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+            errors = dict(self.errors)
+        return [
+            {
+                "区間": name,
+                "件数": len(values),
+                "エラー": errors.get(name, 0),
+                "合計秒": round(sum(values), 2),
+                "平均秒": round(sum(values) / len(values), 3),
+                "p50秒": round(percentile(values, 0.5), 3),
+                "p95秒": round(percentile(values, 0.95), 3),
+                "最大秒": round(max(values), 3),
+            }
+            for name, values in sorted(durations.items(), key=lambda kv: -sum(kv[1]))
+        ]
 
-    return soup.get_text(separator="\n", strip=True)
+    def to_json(self) -> str:
+        with self._lock:
+            payload = {
+                "spans": {
+                    name: {
+                        "count": len(values),
+                        "errors": self.errors.get(name, 0),
+                        "sum": round(sum(values), 4),
+                        "p50": round(percentile(values, 0.5), 4),
+                        "p95": round(percentile(values, 0.95), 4),
+                        "max": round(max(values), 4),
+                    }
+                    for name, values in self.durations.items()
+                },
+                "counters": dict(self.counters),
+                "urls": {
+                    url: {"spans": {name: round(seconds, 4) for name, seconds in spans.items()}, "errors": self.url_errors.get(url, [])}
+                    for url, spans in self.by_url.items()
+                },
+            }
+        return json.dumps(payload, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix: str = "web_unsafe") -> str:
+        with self._lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+            errors = dict(self.errors)
+            counters = dict(self.counters)
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent per span.",
+            f"# TYPE {prefix}_span_seconds summary",
+        ]
+        for name, values in sorted(durations.items()):
+            for q in (0.5, 0.95):
+                lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{q}"}} {percentile(values, q):.6f}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {sum(values):.6f}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {len(values)}')
+        lines += [f"# HELP {prefix}_span_errors_total Spans that ended with an error.", f"# TYPE {prefix}_span_errors_total counter"]
+        for name in sorted(durations):
+            lines.append(f'{prefix}_span_errors_total{{span="{name}"}} {errors.get(name, 0)}')
+        lines += [f"# HELP {prefix}_events_total Events counted during the run.", f"# TYPE {prefix}_events_total counter"]
+        for name, value in sorted(counters.items()):
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+def current_span_context() -> "tuple | None":
+    return getattr(_span_local, "ctx", None)
+
+@contextmanager
+def span_context(recorder: "SpanRecorder | None", url: "str | None" = None):
+    # ctx は current_span_context() の戻り値をそのまま渡してもよい（別スレッドへの引き継ぎ用）
+    previous = current_span_context()
+    _span_local.ctx = (recorder, url)
+    try:
+        yield
+    finally:
+        _span_local.ctx = previous
+
+def record_span(name: str, seconds: float, error: bool = False):
+    ctx = current_span_context()
+    if ctx and ctx[0] is not None:
+        ctx[0].record(name, seconds, ctx[1], error)
+
+def record_count(name: str, ctx: "tuple | None" = None):
+    # ctx を渡すと別スレッド（GPTのイベントループなど）からでも呼び出し元の実行に数えられる
+    ctx = ctx or current_span_context()
+    if ctx and ctx[0] is not None:
+        ctx[0].count(name)
+
+@contextmanager
+def span(name: str):
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_span(name, time.perf_counter() - started, error)
 
+# HTMLは1回だけパースし、本文・body本文・画像情報をそこから取り出す
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# extract_clean_text 用（header, footer, nav, iframe, ins, .footer, [id*="ad"], [class*="ad"] ... に相当）
+CLEAN_SKIP_TAGS = {"header", "footer", "nav", "iframe", "ins", "script", "style"}
+CLEAN_SKIP_CLASSES = {"footer", "header", "ads", "sponsor", "promo", "widget"}
+CLEAN_SKIP_ID_PARTS = ("ad", "sponsor", "banner")
+CLEAN_SKIP_CLASS_PARTS = ("ad", "sponsor", "banner", "rec", "promo")
+# extract_body_text 用
+BODY_SKIP_TAGS = {"header", "footer", "nav", "script", "style"}
+BODY_SKIP_CLASSES = {"footer", "header", "ads"}
+BODY_SKIP_ID_PARTS = ("ad",)
+BODY_SKIP_CLASS_PARTS = ("ad",)
+
+def _make_skip_fn(skip_tags, skip_classes, id_parts, class_parts):
+    def skip(tag: Tag) -> bool:
+        if tag.name in skip_tags:
+            return True
+        classes = tag.get("class") or []
+        if isinstance(classes, str):
+            classes = classes.split()
+        if skip_classes.intersection(classes):
+            return True
+        class_attr = " ".join(classes)
+        if class_attr and any(part in class_attr for part in class_parts):
+            return True
+        tag_id = tag.get("id") or ""
+        return bool(tag_id) and any(part in tag_id for part in id_parts)
+    return skip
+
+_skip_for_clean = _make_skip_fn(CLEAN_SKIP_TAGS, CLEAN_SKIP_CLASSES, CLEAN_SKIP_ID_PARTS, CLEAN_SKIP_CLASS_PARTS)
+_skip_for_body = _make_skip_fn(BODY_SKIP_TAGS, BODY_SKIP_CLASSES, BODY_SKIP_ID_PARTS, BODY_SKIP_CLASS_PARTS)
+
+def _collect_text(root, skip) -> str:
+    # get_text(separator="\n", strip=True) と同じ結果を、除外タグを辿らずに1回の走査で作る
+    parts = []
+    stack = [iter(root.children)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        if isinstance(child, Tag):
+            if not skip(child):
+                stack.append(iter(child.children))
+        elif type(child) in (NavigableString, CData):
+            text = child.strip()
+            if text:
+                parts.append(text)
+    return "\n".join(parts)
+
+class PageDocument:
+    def __init__(self, html: str, status_code: "int | None" = None):
+        self.html = html or ""
+        self.status_code = status_code  # requests で取得した場合のみ
+        self.soup = BeautifulSoup(self.html, HTML_PARSER)
+
+    @cached_property
+    def clean_text(self) -> str:
+        return _collect_text(self.soup, _skip_for_clean)
+
+    @cached_property
+    def body_text(self) -> str:
+        body = self.soup.body
+        return _collect_text(body, _skip_for_body) if body else ""
+
+    @cached_property
+    def first_image(self) -> tuple[str, str]:
+        img = self.soup.find("img")
+        img_src = img["src"] if img and img.get("src") else ""
+        img_alt = img["alt"] if img and img.get("alt") else ""
+        return img_src, img_alt
+
+    @property
+    def image_desc(self) -> str:
+        img_src, img_alt = self.first_image
+        return img_alt or img_src
+
+def extract_clean_text(html: str) -> str:
+    return PageDocument(html).clean_text
 
-GENRE_KEYWORDS, URL_PATTERNS, JAPANESE_DOMAINS = load_rules_from_sheet("GenreRules")
 
-def extract_image_ocr_text(img_path: str) -> str:
+# OCRはプロセスプールで帯ごとに並列実行
+OCR_MODE = os.getenv("OCR_MODE", "full")  # full / auto（本文が十分なら最初の1画面だけ） / auto-skip（本文が十分ならOCRしない） / off
+OCR_MIN_TEXT_CHARS = int(os.getenv("OCR_MIN_TEXT_CHARS", "400"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 2)))
+OCR_BAND_HEIGHT = int(os.getenv("OCR_BAND_HEIGHT", "1000"))
+OCR_BAND_OVERLAP = int(os.getenv("OCR_BAND_OVERLAP", "60"))
+
+@st.cache_resource
+def get_ocr_pool() -> ProcessPoolExecutor:
+    # パイプラインのスレッドが動いている中で fork しないよう spawn で起動
+    pool = ProcessPoolExecutor(max_workers=max(1, OCR_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+    atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+    return pool
+
+def decide_ocr_scope(maintext: str) -> str:
+    # "full" / "viewport" / "skip"
+    if OCR_MODE == "off":
+        return "skip"
+    if OCR_MODE in ("auto", "auto-skip") and len((maintext or "").strip()) >= OCR_MIN_TEXT_CHARS:
+        return "skip" if OCR_MODE == "auto-skip" else "viewport"
+    return "full"
+
+def submit_ocr(png_bytes: bytes, max_height: int = 0) -> list:
+    with Image.open(io.BytesIO(png_bytes)) as img:
+        width, height = img.size
+    boxes = ocr_worker.band_boxes(width, height, OCR_BAND_HEIGHT, OCR_BAND_OVERLAP, max_height)
+    pool = get_ocr_pool()
+    return [pool.submit(ocr_worker.ocr_band, png_bytes, box) for box in boxes]
+
+def collect_ocr(futures: list) -> tuple[str, float]:
+    results = [future.result() for future in futures]
+    return ocr_worker.merge_band_texts(text for text, _ in results), sum(seconds for _, seconds in results)
+
+def extract_image_ocr_text(img_path) -> str:
+    # パスの代わりに Capture やPNGのバイト列も受け付ける
     try:
-        img = Image.open(img_path)
-        return pytesseract.image_to_string(img, lang='jpn+eng').strip()
+        return collect_ocr(submit_ocr(as_capture(img_path).png_bytes))[0]
     except:
         return ""
 
+# ブラウザプール（Chromeを使い回す）
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "50"))  # この件数を処理したら再起動
+BROWSER_WINDOW_SIZE = (1280, 1500)
+
+def build_chrome_options():
+    from selenium.webdriver.chrome.options import Options
+    options = Options()
+    options.add_argument('--headless')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument(f'--window-size={BROWSER_WINDOW_SIZE[0]},{BROWSER_WINDOW_SIZE[1]}')
+    return options
+
+class BrowserPool:
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_pages: int = BROWSER_MAX_PAGES):
+        self.size = max(1, size)
+        self.max_pages = max(1, max_pages)
+        # ドライバーのパス解決は起動時の1回だけ
+        from webdriver_manager.chrome import ChromeDriverManager
+        self.driver_path = ChromeDriverManager().install()
+        self._cond = threading.Condition()
+        self._idle = []  # 空いているブラウザ
+        self._live = 0
+        self._closed = False
+
+    def _launch(self) -> dict:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        driver = webdriver.Chrome(service=Service(self.driver_path), options=build_chrome_options())
+        driver.set_page_load_timeout(20)
+        return {"driver": driver, "pages": 0}
+
+    def _acquire(self) -> dict:
+        with self._cond:
+            while True:
+                # 捨てられたブラウザの分も起動できるよう、起こされるたびに数え直す
+                if self._idle:
+                    return self._idle.pop()
+                if self._live < self.size:
+                    self._live += 1
+                    break
+                self._cond.wait()
+        try:
+            return self._launch()
+        except Exception:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, entry: dict):
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def _discard(self, entry: dict):
+        try:
+            entry["driver"].quit()
+        except Exception:
+            pass
+        with self._cond:
+            self._live -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(driver) -> bool:
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    @staticmethod
+    def _reset_tab(driver):
+        # 前のURLの状態を持ち越さないよう、新しいタブに切り替えて古いタブを閉じる
+        old_handles = driver.window_handles
+        driver.switch_to.new_window("tab")
+        fresh = driver.current_window_handle
+        origins = set()
+        for handle in old_handles:
+            driver.switch_to.window(handle)
+            parsed = urlparse(driver.current_url or "")
+            if parsed.scheme in ("http", "https"):
+                origins.add(f"{parsed.scheme}://{parsed.netloc}")
+            driver.close()
+        driver.switch_to.window(fresh)
+        # delete_all_cookies は今の about:blank の分しか消さないので、CDP でブラウザ全体のCookieと
+        # 前に開いていたオリジンのストレージを消す
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        for origin in origins:
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        driver.set_window_size(*BROWSER_WINDOW_SIZE)
+
+    @contextmanager
+    def session(self):
+        entry = self._acquire()
+        while not self._is_healthy(entry["driver"]):
+            # クラッシュしたブラウザは捨てて取り直す
+            self._discard(entry)
+            entry = self._acquire()
+        failed = False
+        try:
+            self._reset_tab(entry["driver"])
+            yield entry["driver"]
+        except Exception:
+            failed = True
+            raise
+        finally:
+            entry["pages"] += 1
+            recycle = (
+                self._closed
+                or entry["pages"] >= self.max_pages
+                or (failed and not self._is_healthy(entry["driver"]))
+            )
+            if recycle:
+                self._discard(entry)
+            else:
+                self._release(entry)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._discard(entry)
+
+@st.cache_resource
+def get_browser_pool() -> BrowserPool:
+    pool = BrowserPool()
+    atexit.register(pool.close)
+    return pool
+
+# ページの読み込み完了待ち（固定sleepではなくブラウザ側の状態で判定）
+READINESS_PROFILES = {
+    # idle_ms: DOM変化・リソース取得が止まってから待つ時間, max_wait: 1ページあたりの待ち時間の上限
+    "fast": {"idle_ms": 150, "max_wait": 1.5, "scroll": False},
+    "balanced": {"idle_ms": 400, "max_wait": 5.0, "scroll": True},
+    "thorough": {"idle_ms": 1000, "max_wait": 12.0, "scroll": True},
+}
+READINESS_PROFILE = os.getenv("READINESS_PROFILE", "balanced")
+
+# readyState=complete、未完了の画像なし、DOM変化とリソース取得が idle_ms 止まったら完了
+WAIT_FOR_QUIET_JS = """
+const [idleMs, maxWaitMs, includeLazy, done] = arguments;
+const start = performance.now();
+let lastChange = start;
+performance.setResourceTimingBufferSize(10000);
+let lastResources = performance.getEntriesByType('resource').length;
+const observer = new MutationObserver(() => { lastChange = performance.now(); });
+observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+// 遅延読み込み画像は、スクロール後（includeLazy）に読み込みが始まったもの（currentSrc あり）だけ待つ
+const pendingImages = () => Array.from(document.images).filter(img =>
+  !img.complete && (img.loading !== 'lazy' || (includeLazy && img.currentSrc))).length;
+const check = () => {
+  const now = performance.now();
+  const resources = performance.getEntriesByType('resource').length;
+  if (resources !== lastResources) { lastResources = resources; lastChange = now; }
+  const ready = document.readyState === 'complete' && pendingImages() === 0 && now - lastChange >= idleMs;
+  if (ready || now - start >= maxWaitMs) { observer.disconnect(); done(ready); return; }
+  setTimeout(check, 50);
+};
+check();
+"""
+
+# 遅延読み込み画像を発火させるため、1画面ずつスクロールして先頭に戻る
+SCROLL_THROUGH_JS = """
+const [maxWaitMs, done] = arguments;
+const start = performance.now();
+let y = 0;
+const step = () => {
+  const height = Math.max(document.body.scrollHeight, document.documentElement.scrollHeight);
+  if (y >= height || performance.now() - start >= maxWaitMs) { window.scrollTo(0, 0); done(true); return; }
+  window.scrollTo(0, y);
+  y += window.innerHeight;
+  requestAnimationFrame(() => setTimeout(step, 30));
+};
+step();
+"""
+
+def get_readiness_profile(name: str = "") -> dict:
+    return READINESS_PROFILES.get(name or READINESS_PROFILE, READINESS_PROFILES["balanced"])
+
+def wait_for_page_ready(driver, profile: dict, deadline: float, include_lazy: bool = False) -> bool:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return False
+    driver.set_script_timeout(remaining + 5)
+    return bool(driver.execute_async_script(WAIT_FOR_QUIET_JS, profile["idle_ms"], int(remaining * 1000), include_lazy))
+
+def scroll_through_page(driver, deadline: float):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return
+    driver.set_script_timeout(remaining + 5)
+    driver.execute_async_script(SCROLL_THROUGH_JS, int(remaining * 1000))
+
+# スクショはファイルに書かず、PNGのバイト列のままOCR・GPT・Driveに渡す
+GPT_IMAGE_FORMAT = os.getenv("GPT_IMAGE_FORMAT", "jpeg").lower()  # png / jpeg / webp
+GPT_IMAGE_QUALITY = int(os.getenv("GPT_IMAGE_QUALITY", "80"))
+
+class Capture:
+    def __init__(self, png_bytes: bytes, name: str):
+        self.png_bytes = png_bytes
+        self.name = name  # Drive 上のファイル名
+
+    @cached_property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.png_bytes).hexdigest()
+
+    def encode_for_gpt(self, max_size: int = 1600) -> tuple[str, str]:
+        # (MIMEタイプ, base64) を返す。JPEG/WebP にすると送信サイズがかなり小さくなる
+        fmt = GPT_IMAGE_FORMAT if GPT_IMAGE_FORMAT in ("png", "jpeg", "webp") else "png"
+        with Image.open(io.BytesIO(self.png_bytes)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((max_size, max_size))  # リサイズ
+            buffered = io.BytesIO()
+            if fmt == "png":
+                img.save(buffered, format="PNG")
+            else:
+                img.save(buffered, format=fmt.upper(), quality=GPT_IMAGE_QUALITY)
+        return f"image/{fmt}", base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+    def media_upload(self, resumable: bool = False):
+        from googleapiclient.http import MediaIoBaseUpload
+        return MediaIoBaseUpload(io.BytesIO(self.png_bytes), mimetype="image/png", resumable=resumable)
+
+def as_capture(image) -> "Capture | None":
+    # Capture / PNGバイト列 / ファイルパスのどれでも受け付ける
+    if image is None or isinstance(image, Capture):
+        return image
+    if isinstance(image, bytes):
+        return Capture(image, "screenshot.png")
+    if image and os.path.isfile(image):
+        with open(image, "rb") as f:
+            return Capture(f.read(), os.path.basename(image))
+    return None
+
 # スクショ
-def take_fullpage_screenshot(driver, save_path):
+def take_fullpage_screenshot(driver, name, profile: dict = None, deadline: float = 0) -> "Capture | None":
+    profile = profile or get_readiness_profile()
+    deadline = deadline or time.time() + profile["max_wait"]
     try:
-        # JavaScriptの読み込み待ち（最大5秒）
-        for _ in range(5):
-            ready_state = driver.execute_script("return document.readyState")
-            if ready_state == "complete":
-                break
-            time.sleep(1)
+        wait_for_page_ready(driver, profile, deadline)
+        if profile["scroll"]:
+            scroll_through_page(driver, deadline)
 
         # ページ全体のサイズ取得
         total_height = driver.execute_script("return Math.max(document.body.scrollHeight, document.documentElement.scrollHeight)")
         total_width = driver.execute_script("return Math.max(document.body.scrollWidth, document.documentElement.scrollWidth)")
 
         driver.set_window_size(total_width, total_height)
-        time.sleep(2)  # ウィンドウリサイズ反映待ち
-
-        # スクロールしてからキャプチャすることで読み込みが安定
-        driver.execute_script("window.scrollTo(0, 0)")
-        time.sleep(0.5)
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight / 2)")
-        time.sleep(0.5)
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
-        time.sleep(0.5)
-        driver.execute_script("window.scrollTo(0, 0)")
-        time.sleep(1.5)
-
-        driver.save_screenshot(save_path)
-        if os.path.exists(save_path):
-            return save_path
-        else:
-            raise FileNotFoundError("スクリーンショット保存に失敗しました")
+        # リサイズ後の再レイアウトと、新たに見えた画像（遅延読み込みも含む）の読み込みを待つ
+        wait_for_page_ready(driver, profile, deadline, include_lazy=True)
+
+        return Capture(driver.get_screenshot_as_png(), name)
     except Exception as e:
         st.warning(f"📸 スクリーンショットエラー: {e}")
-        return ""
-
-def crawl_with_ocr(url: str, idx: int) -> tuple[str, str, str, str, str]:
+        return None
+
+# タイル撮影（ウィンドウを縦に伸ばさず、CDPでページを分割キャプチャ）
+CAPTURE_MODE = os.getenv("CAPTURE_MODE", "tiled")  # tiled / full
+CAPTURE_MAX_HEIGHT = int(os.getenv("CAPTURE_MAX_HEIGHT", "10000"))  # これより下は撮らない
+CAPTURE_TILE_HEIGHT = int(os.getenv("CAPTURE_TILE_HEIGHT", "2000"))
+COMPOSITE_MAX_SIZE = int(os.getenv("COMPOSITE_MAX_SIZE", "1600"))  # gpt_judge_image の thumbnail と同じ
+
+def take_tiled_screenshot(driver, name, profile: dict = None, deadline: float = 0, on_tile=None) -> "Capture | None":
+    # タイルは on_tile(png_bytes, top) に渡し、手元に残すのは縮小済みの合成画像だけ
+    profile = profile or get_readiness_profile()
+    deadline = deadline or time.time() + profile["max_wait"]
     try:
-        try:
-            resp = requests.get(url, timeout=10)
-            resp.encoding = resp.apparent_encoding
-            maintext = extract_clean_text(resp.text)
-        except Exception:
-            maintext = ""
-
-        shot_path = f"screenshot_{idx}.png"
-        driver = None
-        try:
-            options = Options()
-            options.add_argument('--headless') 
-            options.add_argument('--disable-gpu')
-            options.add_argument('--no-sandbox')
-            options.add_argument('--disable-dev-shm-usage')
-            options.add_argument('--window-size=1280,1500') 
-            service = Service(ChromeDriverManager().install())
-            driver = webdriver.Chrome(service=service, options=options)
-            driver.set_page_load_timeout(20)
-            driver.get(url)
-            time.sleep(2.5)
-            html = driver.page_source
-            shot_path = take_fullpage_screenshot(driver, shot_path)
-
-            if not maintext:
-                maintext = extract_clean_text(driver.page_source)
-
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-            img = soup.find("img")
-            img_src = img["src"] if img and img.get("src") else ""
-            img_alt = img["alt"] if img and img.get("alt") else ""
-            image_desc = img_alt or img_src
+        wait_for_page_ready(driver, profile, deadline)
+        if profile["scroll"]:
+            scroll_through_page(driver, deadline)
+            # スクロールで読み込みが始まった画像が空白のまま撮られないよう、もう一度待つ
+            wait_for_page_ready(driver, profile, deadline, include_lazy=True)
 
-        except Exception:
-            image_desc = ""
-        finally:
-            if driver:
-                driver.quit()
+        total_height = driver.execute_script("return Math.max(document.body.scrollHeight, document.documentElement.scrollHeight)")
+        total_width = driver.execute_script("return Math.max(document.body.scrollWidth, document.documentElement.scrollWidth)")
+        width = max(1, int(total_width))
+        height = max(1, min(int(total_height), CAPTURE_MAX_HEIGHT))
+
+        scale = min(1.0, COMPOSITE_MAX_SIZE / width, COMPOSITE_MAX_SIZE / height)
+        composite = Image.new("RGB", (max(1, round(width * scale)), max(1, round(height * scale))), "white")
+        for top in range(0, height, CAPTURE_TILE_HEIGHT):
+            tile_height = min(CAPTURE_TILE_HEIGHT, height - top)
+            # OCRで境目の行が切れないよう、上のタイルと少し重ねて撮る
+            clip_top = max(0, top - OCR_BAND_OVERLAP)
+            shot = driver.execute_cdp_cmd("Page.captureScreenshot", {
+                "format": "png",
+                "captureBeyondViewport": True,
+                "clip": {"x": 0, "y": clip_top, "width": width, "height": top + tile_height - clip_top, "scale": 1},
+            })
+            png_bytes = base64.b64decode(shot["data"])
+            if on_tile:
+                on_tile(png_bytes, top)
+            with Image.open(io.BytesIO(png_bytes)) as tile:
+                tile = tile.crop((0, top - clip_top, tile.width, tile.height))
+                resized = tile.convert("RGB").resize((composite.width, max(1, round(tile_height * scale))))
+            composite.paste(resized, (0, round(top * scale)))
+            del png_bytes, resized
+
+        buffered = io.BytesIO()
+        composite.save(buffered, format="PNG")
+        return Capture(buffered.getvalue(), name)
+    except Exception as e:
+        st.warning(f"📸 スクリーンショットエラー: {e}")
+        return None
 
-        ocr_text = extract_image_ocr_text(shot_path if os.path.exists(shot_path) else "")
-        image_combined_desc = image_desc + "\n" + ocr_text
+def fetch_page(url: str) -> "PageDocument | None":
+    try:
+        with span("fetch"):
+            resp = get_http_fetcher().get(url)
+        if resp is None:
+            return None
+        with span("parse"):
+            return PageDocument(resp.text, resp.status_code)
+    except Exception:
+        return None
 
-        if not maintext.strip():
-            maintext = "本文取得失敗"
-        return maintext, image_combined_desc, shot_path, html if os.path.exists(shot_path) else "", ocr_text
+def render_page(url: str, idx: int, doc: "PageDocument | None" = None, readiness: str = "", on_tile=None) -> tuple["PageDocument | None", "Capture | None"]:
+    # 取得済みのHTMLがあればそれを使い、ブラウザはスクショ専用にする
+    capture = None
+    name = f"screenshot_{idx}.png"
+    profile = get_readiness_profile(readiness)
+    try:
+        with get_browser_pool().session() as driver:
+            with span("navigate"), get_http_fetcher().limiter.slot(url):
+                driver.get(url)
+            deadline = time.time() + profile["max_wait"]
+            with span("screenshot"):
+                if CAPTURE_MODE == "full":
+                    capture = take_fullpage_screenshot(driver, name, profile, deadline)
+                else:
+                    capture = take_tiled_screenshot(driver, name, profile, deadline, on_tile=on_tile)
+            if doc is None or not doc.clean_text:
+                doc = PageDocument(driver.page_source)
+    except Exception:
+        pass
+    return doc, capture
+
+# パイプラインの各ステージ（item は URL ごとの dict）
+def stage_fetch(item: dict, cache: "ResultCache | None" = None):
+    # URLだけで確定するものは取得もしない
+    if decide_by_cascade(item, ("url",)):
+        return
+    item["doc"] = fetch_page(item["url"])
+    if cache is not None:
+        item["content_hash"] = content_hash_of(item["doc"].clean_text if item["doc"] else "")
+        cached = cache.get(item["url"], item["content_hash"])
+        item["cache_hit"] = cached is not None
+        if cached is not None:
+            # 前回から変わっていないページはそのまま書き込みへ
+            item["cached_result"] = cached
+            item["skip_stages"] = {"render", "ocr", "gpt"}
+            return
+    decide_by_cascade(item, ("status", "keywords"))
+
+def stage_render(item: dict, dup_index: "NearDupIndex | None" = None):
+    doc = item.get("doc")
+    ocr_scope = decide_ocr_scope(doc.clean_text if doc else "")
+    item["ocr_scope"] = ocr_scope
+    item["ocr_futures"] = None
+
+    item.pop("first_screen_hash", None)
+
+    def on_tile(png_bytes, top):
+        if dup_index is not None and top == 0:
+            # 合成画像は縮小されていてページの長さで倍率が変わるので、近似重複の dHash は元の解像度の先頭タイルで取る
+            item["first_screen_hash"] = dhash(png_bytes)
+        # タイルは撮れた順にOCRプールへ流す
+        if ocr_scope == "skip" or (ocr_scope == "viewport" and top > 0):
+            return
+        max_height = BROWSER_WINDOW_SIZE[1] if ocr_scope == "viewport" else 0
+        item["ocr_futures"] = (item["ocr_futures"] or []) + submit_ocr(png_bytes, max_height)
+
+    item["doc"], item["capture"] = render_page(item["url"], item["idx"], doc, item.get("readiness", ""), on_tile)
+    doc = item["doc"]
+    item["maintext"] = doc.clean_text if doc else ""
+    item["image_desc"] = doc.image_desc if doc else ""
+    item["html"] = doc.html if doc else ""
+    if dup_index is not None:
+        find_near_duplicate(item, dup_index)
+
+def stage_ocr(item: dict):
+    capture = item["capture"]
+    futures = item.pop("ocr_futures", None)
+    ocr_scope = item.get("ocr_scope", "full")
+    if futures is None and capture and ocr_scope != "skip":
+        # 全体スクショ（CAPTURE_MODE=full）の場合は画像を帯に分ける
+        futures = submit_ocr(capture.png_bytes, BROWSER_WINDOW_SIZE[1] if ocr_scope == "viewport" else 0)
+    with span("ocr_wait"):
+        item["ocr_text"], item["ocr_seconds"] = collect_ocr(futures or [])
+    if futures:
+        record_span("ocr_cpu", item["ocr_seconds"])  # 帯ごとのOCR時間の合計（子プロセス側）
+    item["image_desc"] = item["image_desc"] + "\n" + item["ocr_text"]
+    if not item["maintext"].strip():
+        item["maintext"] = "本文取得失敗"
+
+def crawl_with_ocr(url: str, idx: int) -> tuple[str, str, "Capture | None", str, str]:
+    item = {"url": url, "idx": idx}
+    try:
+        stage_fetch(item)
+        stage_render(item)
+        stage_ocr(item)
+        return item["maintext"], item["image_desc"], item["capture"], item["html"], item["ocr_text"]
     except Exception as e:
-        return "本文取得失敗", "", ""
+        return "本文取得失敗", "", None, "", ""
 
 # キーワード及びジャンル判定
-def judge_keywords_by_count(text, keywords_dict):
-    results = []
-    for genre, patterns in keywords_dict.items():
-        matched = []
-        for pattern in patterns:
+# GenreRules は一度だけコンパイルして使い回す
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+class LiteralIndex:
+    # 複数リテラルを1パスで検索（pyahocorasick が無い場合は部分文字列検索）
+    def __init__(self, literals: dict):
+        self.literals = literals  # 小文字のリテラル -> ルールIDのリスト
+        self.automaton = None
+        if ahocorasick is not None and literals:
+            automaton = ahocorasick.Automaton()
+            for literal, ids in literals.items():
+                automaton.add_word(literal, ids)
+            automaton.make_automaton()
+            self.automaton = automaton
+
+    def find(self, text_lower: str) -> set:
+        found = set()
+        if self.automaton is not None:
+            for _, ids in self.automaton.iter(text_lower):
+                found.update(ids)
+        else:
+            for literal, ids in self.literals.items():
+                if literal in text_lower:
+                    found.update(ids)
+        return found
+
+class RuleMatcher:
+    def __init__(self, genre_keywords: dict, url_patterns: dict):
+        # キーワード: メタ文字を含まないものはオートマトン、それ以外は事前コンパイルした正規表現
+        self.keywords = []  # ルールID -> (genre, pattern)
+        self.keyword_regexes = {}
+        literals = {}
+        for genre, patterns in genre_keywords.items():
+            for pattern in patterns:
+                kid = len(self.keywords)
+                self.keywords.append((genre, pattern))
+                if re.escape(pattern) == pattern:
+                    literals.setdefault(pattern.lower(), []).append(kid)
+                    continue
+                try:
+                    self.keyword_regexes[kid] = re.compile(pattern, re.IGNORECASE)
+                except re.error:
+                    continue  # エラー無視
+        self.keyword_index = LiteralIndex(literals)
+
+        # URLパターン: ワイルドカード以外で一番長い部分を候補絞り込みに使う
+        self.patterns = []  # ルールID -> (genre, pattern, regex)
+        self.unanchored_patterns = set()
+        anchors = {}
+        for genre, patterns in url_patterns.items():
+            for patt in patterns:
+                pid = len(self.patterns)
+                patt_regex = re.escape(patt).replace(r'\*', '.*')
+                self.patterns.append((genre, patt, re.compile(patt_regex, re.IGNORECASE)))
+                anchor = max(patt.split("*"), key=len).lower()
+                if anchor:
+                    anchors.setdefault(anchor, []).append(pid)
+                else:
+                    self.unanchored_patterns.add(pid)
+        self.pattern_index = LiteralIndex(anchors)
+
+    def match_keywords(self, text: str) -> list:
+        hits = self.keyword_index.find(text.lower())
+        for kid, regex in self.keyword_regexes.items():
+            if regex.search(text):
+                hits.add(kid)
+        matched_by_genre = {}
+        for kid in sorted(hits):
+            genre, pattern = self.keywords[kid]
+            matched_by_genre.setdefault(genre, []).append(pattern)
+        return [(genre, len(matched), matched) for genre, matched in matched_by_genre.items()]
+
+    def match_url_patterns(self, targets) -> tuple:
+        # 元の順序（ジャンル → パターン → 対象）で最初に一致したものを返す
+        candidates = [
+            (target, self.pattern_index.find(target.lower()) | self.unanchored_patterns)
+            for target in targets if target
+        ]
+        for pid in sorted(set().union(*(ids for _, ids in candidates))):
+            genre, patt, regex = self.patterns[pid]
+            for target, ids in candidates:
+                if pid in ids and regex.search(target):
+                    return genre, patt
+        return None, None
+
+class DomainSuffixIndex:
+    # jpdomain ルールの domain.endswith(rule) を、ラベルを右から辿るトライで引く
+    # 一番左のラベルだけは部分一致（"co.jp" は "xco.jp" にも当たる）で、endswith と同じ結果になる
+    def __init__(self, suffixes):
+        self.root = {"children": {}, "tails": set()}
+        for suffix in suffixes:
+            *labels, tail = suffix.split(".")[::-1]
+            node = self.root
+            for label in labels:
+                node = node["children"].setdefault(label, {"children": {}, "tails": set()})
+            node["tails"].add(tail)
+
+    def match(self, domain: str) -> bool:
+        node = self.root
+        for label in reversed(domain.split(".")):
+            if any(label.endswith(tail) for tail in node["tails"]):
+                return True
+            node = node["children"].get(label)
+            if node is None:
+                return False
+        return False
+
+# GenreRules のキャッシュ（GenreRules シートの内容が変わった時だけコンパイルし直す）
+RULES_SHEET_NAME = "GenreRules"
+RULES_CHECK_INTERVAL = float(os.getenv("RULES_CHECK_INTERVAL", "30"))  # 更新確認の最短間隔（秒）
+
+def rules_version(rows: list) -> str:
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class GenreRules:
+    def __init__(self, genre_keywords: dict, url_patterns: dict, japanese_domains: list, version: str = ""):
+        self.genre_keywords = genre_keywords
+        self.url_patterns = url_patterns
+        self.japanese_domains = japanese_domains
+        self.matcher = RuleMatcher(genre_keywords, url_patterns)
+        self.domain_index = DomainSuffixIndex(japanese_domains)
+        self.version = version  # GenreRules シートの内容のハッシュ
+        self.loaded_at = time.time()
+
+class RuleStore:
+    def __init__(self, sheet_name: str = RULES_SHEET_NAME, check_interval: float = RULES_CHECK_INTERVAL):
+        self.sheet_name = sheet_name
+        self.check_interval = check_interval
+        self.rules = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> GenreRules:
+        # 判定結果は同じスプレッドシートの別シートに書くので、ファイルの更新日時ではなく
+        # GenreRules シートだけを1回で読み、その内容のハッシュで変更を見る
+        with self._lock:
+            now = time.time()
+            if self.rules is not None and not force and now - self.checked_at < self.check_interval:
+                return self.rules
+            self.checked_at = now
             try:
-                if re.search(pattern, text, re.IGNORECASE):
-                    matched.append(pattern)
-            except re.error:
-                continue  # エラー無視
-        if matched:
-            results.append((genre, len(matched), matched))
-    return results
+                rows = read_rule_rows(self.sheet_name)
+            except Exception:
+                if self.rules is None:
+                    raise
+                return self.rules  # 確認できない場合は手元のルールを使い続ける
+            version = rules_version(rows)
+            if self.rules is not None and version == self.rules.version:
+                return self.rules
+            self.rules = GenreRules(*parse_rule_rows(rows), version=version)
+            return self.rules
+
+    def current(self) -> GenreRules:
+        return self.rules if self.rules is not None else self.refresh()
+
+@st.cache_resource
+def get_rule_store() -> RuleStore:
+    return RuleStore()
+
+def current_rules() -> GenreRules:
+    return get_rule_store().current()
+
+def judge_keywords_by_count(text, keywords_dict):
+    matcher = keywords_dict if isinstance(keywords_dict, RuleMatcher) else RuleMatcher(keywords_dict, {})
+    return matcher.match_keywords(text)
 
 def judge_genre_by_patterns(targets, patterns_dict):
-    for genre, patterns in patterns_dict.items():
-        for patt in patterns:
-            patt_regex = re.escape(patt).replace(r'\*', '.*')
-            for target in targets:
-                if target and re.search(patt_regex, target, re.IGNORECASE):
-                    return genre, patt
-    return None, None
+    matcher = patterns_dict if isinstance(patterns_dict, RuleMatcher) else RuleMatcher({}, patterns_dict)
+    return matcher.match_url_patterns(targets)
 
 def judge_genre_final(url, text, image_desc, image_url, keywords_dict, url_patterns, gpt_fn=None):
     targets = [url, image_url, image_desc]
@@ -271,10 +1097,175 @@ def judge_genre_final(url, text, image_desc, image_url, keywords_dict, url_patte
         return f"[GPT判定] {gpt_fn(text, image_desc, keywords_dict)}"
     return "判定不可"
 
+# --- GPT（非同期クライアント） ---
+# 同時実行数の上限、レスポンスヘッダーに基づくレート制御、429/5xx のリトライ、同一リクエストの重複排除を行う
+GPT_MODEL = "gpt-4o"
+GPT_MAX_IN_FLIGHT = int(os.getenv("GPT_MAX_IN_FLIGHT", "8"))
+GPT_MAX_RETRIES = int(os.getenv("GPT_MAX_RETRIES", "6"))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # OpenAI互換のローカルサーバーで試験する場合に指定
+
+class GptUnavailableError(Exception):
+    # リトライしても 429/5xx/接続エラーが続いた場合（シートに「GPTエラー」を書かずにURLごと失敗にする）
+    pass
+
+def parse_reset_seconds(value: str) -> float:
+    # "1s", "6m0s", "20ms" 形式
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(num) * units[unit] for num, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""))
+
+class TokenBucket:
+    def __init__(self):
+        self.capacity = None  # ヘッダーを受け取るまでは無制限
+        self.tokens = 0.0
+        self.rate = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        if self.capacity is None:
+            return 0.0
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def consume(self, amount: float):
+        if self.capacity is not None:
+            self.tokens -= amount
+
+    def update(self, limit: int, remaining: int, reset_seconds: float):
+        self._refill()
+        self.capacity = float(limit)
+        self.tokens = float(remaining)
+        missing = limit - remaining
+        self.rate = missing / reset_seconds if missing > 0 and reset_seconds > 0 else limit / 60
+
+class GptRateLimiter:
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int):
+        async with self._lock:
+            while True:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(min(wait, 30))
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+
+    def update(self, headers):
+        if not headers:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            try:
+                limit = int(headers.get(f"x-ratelimit-limit-{kind}"))
+                remaining = int(headers.get(f"x-ratelimit-remaining-{kind}"))
+            except (TypeError, ValueError):
+                continue
+            bucket.update(limit, remaining, parse_reset_seconds(headers.get(f"x-ratelimit-reset-{kind}", "")))
+
+def estimate_tokens(messages: list, max_tokens: int) -> int:
+    # 日本語は1文字≒1トークン、画像は低めに見積もる
+    total = max_tokens
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            total += len(part.get("text", "")) if part.get("type") == "text" else 800
+    return total
+
+def retry_delay(error, attempt: int) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers.get(name)) * scale
+        except (TypeError, ValueError):
+            continue
+    return min(2 ** attempt, 60) + random.random()
+
+class AsyncGptClient:
+    def __init__(self, api_key: str = GPT_API_KEY, base_url: str = OPENAI_BASE_URL, max_in_flight: int = GPT_MAX_IN_FLIGHT):
+        # 専用スレッドでイベントループを回し、パイプラインの各スレッドから投げ込む
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        import openai
+        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url or None, max_retries=0)
+        self.limiter = GptRateLimiter()
+        self.semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        self._inflight = {}  # リクエストのハッシュ -> Task（実行中の重複排除）
+
+    async def _create(self, request: dict) -> str:
+        import openai
+        for attempt in range(GPT_MAX_RETRIES + 1):
+            await self.limiter.acquire(estimate_tokens(request["messages"], request["max_tokens"]))
+            try:
+                async with self.semaphore:
+                    raw = await self.client.chat.completions.with_raw_response.create(model=GPT_MODEL, **request)
+                self.limiter.update(raw.headers)
+                return raw.parse().choices[0].message.content.strip()
+            except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+                self.limiter.update(getattr(getattr(e, "response", None), "headers", None))
+                if attempt >= GPT_MAX_RETRIES:
+                    raise GptUnavailableError(f"GPT APIが応答しません（{GPT_MAX_RETRIES}回リトライ）: {e}") from e
+                await asyncio.sleep(retry_delay(e, attempt))
+
+    async def create(self, request: dict, ctx: "tuple | None" = None) -> str:
+        # 同じプロンプト・同じ画像のリクエストは1回だけ送る
+        key = hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = self.loop.create_task(self._create(request))
+            self._inflight[key] = task
+
+            def forget_failed(t):
+                # 失敗したものは次回やり直せるよう記録から外す
+                if t.cancelled() or t.exception() is not None:
+                    self._inflight.pop(key, None)
+            task.add_done_callback(forget_failed)
+        else:
+            record_count("gpt_deduped", ctx)  # 区間の計測と同じく、呼び出し元の実行の件数に入れる
+        return await asyncio.shield(task)
+
+    def run(self, *requests: dict) -> list:
+        # 複数のリクエストを同時に投げて結果（または例外）を順に返す
+        return [result for result, _ in self.run_timed(*requests)]
+
+    def run_timed(self, *requests: dict) -> list:
+        # run と同じだが (結果または例外, 所要秒) を返す
+        ctx = current_span_context()
+
+        async def timed(request):
+            started = time.perf_counter()
+            try:
+                result = await self.create(request, ctx)
+            except Exception as e:
+                result = e
+            return result, time.perf_counter() - started
+
+        async def gather():
+            return await asyncio.gather(*(timed(r) for r in requests))
+        return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
+
+    def reset_dedupe(self):
+        # 実行（判定ボタン）ごとに重複排除の記録をリセット
+        self.loop.call_soon_threadsafe(self._inflight.clear)
+
+@st.cache_resource
+def get_gpt_client() -> AsyncGptClient:
+    return AsyncGptClient()
+
 # --- GPT ---
-def gpt_judge_genre(maintext, image_desc, keywords_dict):
-    if not GPT_API_KEY:
-        return "GPT未実行"
+def build_genre_request(maintext, image_desc) -> dict:
     maintext_short = maintext[:800] if len(maintext) > 800 else maintext
     image_desc_short = image_desc[:300] if len(image_desc) > 300 else image_desc
     full_context = f"[本文（最大800字）]:\n{maintext_short}\n\n[画像の説明・OCR結果（最大300字）]:\n{image_desc_short}"
@@ -317,107 +1308,195 @@ def gpt_judge_genre(maintext, image_desc, keywords_dict):
     "[ジャンル]: ○○（複数あればカンマ区切り）\n"
     "[理由]: ジャンル判定の根拠を簡潔に記載\n"
 )
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": genre_prompt}],
-            max_tokens=200,
-            temperature=0.2,
-        )
-        content = response.choices[0].message.content.strip()
-        genre_match = re.search(r"\[ジャンル\]:\s*([^\n/]+)", content)
-        reason_match = re.search(r"\[理由\]:\s*(.+)", content)
+    return {
+        "messages": [{"role": "user", "content": genre_prompt}],
+        "max_tokens": 200,
+        "temperature": 0.2,
+    }
+
+def parse_genre_answer(content: str) -> str:
+    genre_match = re.search(r"\[ジャンル\]:\s*([^\n/]+)", content)
+    reason_match = re.search(r"\[理由\]:\s*(.+)", content)
+
+    if genre_match:
+        genre_text = genre_match.group(1).strip()
+        if any(x in genre_text for x in ["要確認", "該当なし", "カテゴリー該当なし"]):
+            return "[ジャンル]: カテゴリー該当なし"
+        return f"[ジャンル]: {genre_text} / [理由]: {reason_match.group(1).strip() if reason_match else 'なし'}"
+
+    return "[ジャンル]: カテゴリー該当なし"
+
+def build_image_request(image, alt_ocr_text="") -> "dict | str":
+    # 画像が大きすぎる場合はエラーメッセージ（str）を返す
+    mime_type, base64_image = as_capture(image).encode_for_gpt()
+
+    # base64 大きさのはみ出し防止
+    if len(base64_image) > 4_000_000:
+        return f"画像サイズ過大（{len(base64_image)}バイト）でGPT不可"
+
+    messages = [
+        {"role": "user", "content":
+        "以下の画像とそのOCR/ALTテキストを分析し、該当するジャンルがあれば判定してください。\n"
+        "明確に該当しない場合のみ [要確認] とし、少しでも該当の可能性があれば該当ジャンルを挙げてください。ジャンル名の後ろに補足があっても構いません。（例: アダルト（疑いあり））\n\n"
+        "【ジャンル定義】\n"
+        "- 閲覧不可：閲覧が制限されている表示\n"
+        "- 認証が必要：ログインを求めるページ\n"
+        "- アダルト：R18、性的な画像・警告表示\n"
+        "- 悪質CGM：掲示板・不適切なコメント多数\n"
+        "- 著作権侵害：動画・画像・漫画などの無断転載\n"
+        "- ポイント：報酬付き広告、ポイント交換案内\n"
+        "- ヘイト/センシティブ：差別表現や中傷がある\n"
+        "- 危険物：薬物・毒物・暴力的な描写\n"
+        "- グロテスク：死体・事故・自殺など\n"
+        "- ネガティブ：悲惨な内容、絶望的表現\n"
+        "- 海外サイト：英語など外国語表示のもの\n\n"
+        f"[OCR/ALTテキストの一部]: {alt_ocr_text[:200]}\n"
+        "【出力形式】\n"
+        "[ジャンル]: ○○ / [理由]: ○○○○"
+        },
+        {"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}
+        ]}
+    ]
+    return {"messages": messages, "max_tokens": 200, "temperature": 0.3}
 
-        if genre_match:
-            genre_text = genre_match.group(1).strip()
-            if any(x in genre_text for x in ["要確認", "該当なし", "カテゴリー該当なし"]):
-                return "[ジャンル]: カテゴリー該当なし"
-            return f"[ジャンル]: {genre_text} / [理由]: {reason_match.group(1).strip() if reason_match else 'なし'}"
+# 事前分類（シートの R/Y列で学習した軽いモデル。確信度が閾値以上なら GPT の本文判定を省く）
+# モデルは python preclassifier.py train で作る。ファイルが無ければ使わない
+PRECLASSIFIER_MODEL = os.getenv("PRECLASSIFIER_MODEL", "preclassifier.npz")
+PRECLASSIFIER_THRESHOLD = os.getenv("PRECLASSIFIER_THRESHOLD", "")  # 未設定なら学習時に選んだ閾値
 
-        return "[ジャンル]: カテゴリー該当なし"
-    except Exception as e:
-        return f"GPTエラー: {str(e)}"
+@st.cache_resource(max_entries=1)
+def load_preclassifier(path: str, mtime: float):
+    # mtime はキャッシュのキー（学習し直したら読み直す）
+    import preclassifier
+    return preclassifier.PreClassifier.load(path, tokenize=get_words)
+
+def get_preclassifier():
+    # モデルが無い時は毎回ファイルを見る（後から学習したモデルも再起動せずに使われる）
+    try:
+        mtime = os.path.getmtime(PRECLASSIFIER_MODEL)
+    except OSError:
+        return None
+    return load_preclassifier(PRECLASSIFIER_MODEL, mtime)
+
+def preclassify_genre(maintext: str) -> "str | None":
+    # 確信が持てる時だけ parse_genre_answer と同じ形の判定を返す
+    model = get_preclassifier()
+    if model is None or not maintext.strip() or maintext == "本文取得失敗":
+        return None
+    threshold = float(PRECLASSIFIER_THRESHOLD) if PRECLASSIFIER_THRESHOLD else model.threshold
+    with span("preclassify"):
+        genre, confidence = model.predict(maintext[:1200])  # R列と同じ長さで見る
+    if confidence < threshold:
+        return None
+    return f"[ジャンル]: {genre} / [理由]: 事前分類（確信度 {confidence:.2f}）"
+
+def is_preclassified(item: dict) -> bool:
+    # この実行で、その item 自身の GPT本文判定を事前分類で省いたか（流用・キャッシュの分は数えない）
+    return bool(item.get("preclassified"))
+
+def gpt_judge_genre(maintext, image_desc, keywords_dict):
+    if not GPT_API_KEY:
+        return "GPT未実行"
+    return gpt_judge_both(maintext, image_desc, "")[0]
 
 def gpt_judge_image(image_path, alt_ocr_text=""):
-    if not GPT_API_KEY or not os.path.exists(image_path):
+    capture = as_capture(image_path)
+    if not GPT_API_KEY or capture is None:
         return "画像未解析"
-    try:
-        with open(image_path, "rb") as f:
-            img_bytes = f.read()
-        with Image.open(image_path) as img:
-            img = img.convert("RGB")
-            img.thumbnail((1600, 1600))  # リサイズ
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            img_bytes = buffered.getvalue()
-        base64_image = base64.b64encode(img_bytes).decode("utf-8")
-
-        # base64 大きさのはみ出し防止
-        if len(base64_image) > 4_000_000:
-            return f"画像サイズ過大（{len(base64_image)}バイト）でGPT不可"
-
-        messages = [
-            {"role": "user", "content":
-            "以下の画像とそのOCR/ALTテキストを分析し、該当するジャンルがあれば判定してください。\n"
-            "明確に該当しない場合のみ [要確認] とし、少しでも該当の可能性があれば該当ジャンルを挙げてください。ジャンル名の後ろに補足があっても構いません。（例: アダルト（疑いあり））\n\n"
-            "【ジャンル定義】\n"
-            "- 閲覧不可：閲覧が制限されている表示\n"
-            "- 認証が必要：ログインを求めるページ\n"
-            "- アダルト：R18、性的な画像・警告表示\n"
-            "- 悪質CGM：掲示板・不適切なコメント多数\n"
-            "- 著作権侵害：動画・画像・漫画などの無断転載\n"
-            "- ポイント：報酬付き広告、ポイント交換案内\n"
-            "- ヘイト/センシティブ：差別表現や中傷がある\n"
-            "- 危険物：薬物・毒物・暴力的な描写\n"
-            "- グロテスク：死体・事故・自殺など\n"
-            "- ネガティブ：悲惨な内容、絶望的表現\n"
-            "- 海外サイト：英語など外国語表示のもの\n\n"
-            f"[OCR/ALTテキストの一部]: {alt_ocr_text[:200]}\n"
-            "【出力形式】\n"
-            "[ジャンル]: ○○ / [理由]: ○○○○"
-            },
-            {"role": "user", "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}}
-            ]}
-        ]
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=200,
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        return f"画像GPTエラー: {str(e)}"
+    return gpt_judge_both("", alt_ocr_text, capture, judge_text=False)[1]
+
+def gpt_judge_both(maintext, image_desc, capture: "Capture | None", judge_text: bool = True) -> tuple[str, str]:
+    # 本文判定と画像判定を同時に投げる（GptUnavailableError はそのまま上げる）
+    genre_opinion = "GPT未実行"
+    image_opinion = "画像未解析"
+    if judge_text:
+        preclassified = preclassify_genre(maintext)
+        if preclassified is not None:
+            genre_opinion, judge_text = preclassified, False
+    if not GPT_API_KEY:
+        return genre_opinion, image_opinion
+
+    requests_to_send = {}
+    if judge_text:
+        requests_to_send["genre"] = build_genre_request(maintext, image_desc)
+    if capture is not None:
+        try:
+            image_request = build_image_request(capture, image_desc)
+        except Exception as e:
+            image_request = f"画像GPTエラー: {str(e)}"
+        if isinstance(image_request, str):
+            image_opinion = image_request
+        else:
+            requests_to_send["image"] = image_request
+
+    if not requests_to_send:
+        return genre_opinion, image_opinion
+    results = {}
+    for name, (result, seconds) in zip(requests_to_send, get_gpt_client().run_timed(*requests_to_send.values())):
+        record_span(f"gpt_{name}", seconds, isinstance(result, Exception))
+        results[name] = result
+    for result in results.values():
+        if isinstance(result, GptUnavailableError):
+            raise result
+
+    if "genre" in results:
+        result = results["genre"]
+        genre_opinion = f"GPTエラー: {str(result)}" if isinstance(result, Exception) else parse_genre_answer(result)
+    if "image" in results:
+        result = results["image"]
+        image_opinion = f"画像GPTエラー: {str(result)}" if isinstance(result, Exception) else result
+    return genre_opinion, image_opinion
 
 # サイト判断
-def extract_body_text(html: str) -> str:
-    soup = BeautifulSoup(html, "html.parser")
-    body = soup.body
-    if not body:
-        return ""
-    for selector in ['header', 'footer', 'nav', '.footer', '.header', '.ads', '[id*="ad"]', '[class*="ad"]']:
-        for tag in body.select(selector):
-            tag.decompose()
-    for tag in body(["script", "style"]):
-        tag.decompose()
-    return body.get_text(separator="\n", strip=True)
-
-def is_japanese_site_by_html(html: str, threshold: float = 0.4) -> bool:
+def extract_body_text(html) -> str:
+    # パース済みの PageDocument を渡せば再パースしない
+    doc = html if isinstance(html, PageDocument) else PageDocument(html)
+    return doc.body_text
+
+# 文字種の集計（ひらがな・カタカナ・漢字と英字を1回の走査で数える）
+LANG_CHAR_RUNS = re.compile(r'([ぁ-んァ-ン一-龯]+)|([a-zA-Z]+)')  # 1文字ずつでなく連続部分ごとに拾う
+LANG_CHUNK_CHARS = 4096  # この単位で数え、割合の結論が出たら残りは読まない
+LANG_SAMPLE_CHARS = int(os.getenv("LANG_SAMPLE_CHARS", "20000"))  # これより長い本文は均等に抜き出した部分で判定（0で全文）
+LANG_SAMPLE_WINDOWS = 8
+
+def sample_text(text: str, limit: int = LANG_SAMPLE_CHARS) -> str:
+    if not limit or len(text) <= limit:
+        return text
+    size = limit // LANG_SAMPLE_WINDOWS
+    step = (len(text) - size) / (LANG_SAMPLE_WINDOWS - 1)
+    return "".join(text[int(i * step):int(i * step) + size] for i in range(LANG_SAMPLE_WINDOWS))
+
+def language_stats(text: str, threshold: "float | None" = None) -> dict:
+    # threshold を渡すと「日本語文字の割合 >= threshold」が確定した時点で打ち切る（jp/en はそこまでの数）
+    text = sample_text(text or "")
+    total = len(text)
+    jp = en = 0
+    need = threshold * total if threshold is not None and threshold > 0 else None
+    for start in range(0, total, LANG_CHUNK_CHARS):
+        for jp_run, en_run in LANG_CHAR_RUNS.findall(text, start, start + LANG_CHUNK_CHARS):
+            jp += len(jp_run)
+            en += len(en_run)
+        if need is not None:
+            scanned = min(start + LANG_CHUNK_CHARS, total)
+            if jp >= need or jp + (total - scanned) < need:
+                return {"total": total, "jp": jp, "en": en, "scanned": scanned}
+    return {"total": total, "jp": jp, "en": en, "scanned": total}
+
+def is_japanese_site_by_html(html, threshold: float = 0.4) -> bool:
     text = extract_body_text(html)
     if not text:
         return False
-    total_chars = len(text)
-    jp_chars = len(re.findall(r'[ぁ-んァ-ン一-龯]', text))
-    return (jp_chars / total_chars) >= threshold if total_chars > 0 else False
+    stats = language_stats(text, threshold)
+    return (stats["jp"] / stats["total"]) >= threshold if stats["total"] > 0 else False
 
 
-def is_japanese_site_by_html_or_ocr(url: str, html: str, ocr_text: str, threshold: float = 0.4) -> bool:
+def is_japanese_site_by_html_or_ocr(url: str, html, ocr_text: str, threshold: float = 0.4) -> bool:
     domain = extract_domain(url)
-    if any(domain.endswith(jd) for jd in JAPANESE_DOMAINS):
+    if current_rules().domain_index.match(domain):
         return True
 
-    # HTML Body抽出
+    # HTML Body抽出（PageDocument を渡せば抽出済みの本文を使う）
     text = extract_body_text(html)
     
     # HTML Bodyが少ない場合 → OCR テキストで変わって判定
@@ -425,11 +1504,10 @@ def is_japanese_site_by_html_or_ocr(url: str, html: str, ocr_text: str, threshol
         text = ocr_text or ""
     
     # 日本語文字の割合計算（ひらがな、カタカナ、漢字）
-    total_chars = len(text)
-    jp_chars = len(re.findall(r'[ぁ-んァ-ン一-龯]', text))
+    stats = language_stats(text, threshold)
+    total_chars, jp_chars, en_chars = stats["total"], stats["jp"], stats["en"]
 
     # 英語しかなければ海外とみなす (逆補正)
-    en_chars = len(re.findall(r'[a-zA-Z]', text))
     if total_chars > 0 and jp_chars == 0 and en_chars > total_chars * 0.2:
         return False
 
@@ -455,7 +1533,8 @@ def compute_integrated_score(ocr_match_count, gpt_result_text, gpt_image_text):
     return round(min(score, 15), 1)
 
 # Googleドライブにアップロード
-def upload_to_drive(file_path: str, file_name: str) -> str:
+def upload_to_drive(file_path, file_name: str) -> str:
+    # file_path は Capture（メモリ上のPNG）でもファイルパスでもよい
     try:
         # ✅ 업로드할 파일의 메타데이터 정의 (폴더 지정)
         file_metadata = {
@@ -464,9 +1543,10 @@ def upload_to_drive(file_path: str, file_name: str) -> str:
         }
 
         # ✅ 실제 파일 준비
-        media = MediaFileUpload(file_path, resumable=True)
+        media = as_capture(file_path).media_upload(resumable=True)
 
         # ✅ Google Drive에 파일 업로드 실행
+        drive_service = get_drive_service()
         file = drive_service.files().create(
             body=file_metadata,
             media_body=media,
@@ -494,93 +1574,1365 @@ def upload_to_drive(file_path: str, file_name: str) -> str:
         return ""
 
 
-# Streamlit UI
-st.title("Web Unsafe 半定")
-urls_input = st.text_area("対象URL一覧", height=200)
+# Drive アップロード（バックグラウンドで実行し、公開権限はまとめて付与）
+DRIVE_UPLOAD_WORKERS = int(os.getenv("DRIVE_UPLOAD_WORKERS", "4"))
+DRIVE_RESUMABLE_THRESHOLD = int(os.getenv("DRIVE_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024)))  # これ以下はマルチパート1回で送る
+DRIVE_PERMISSION_BATCH = min(100, int(os.getenv("DRIVE_PERMISSION_BATCH", "50")))  # バッチAPIの上限は100件
+
+class DriveUploader:
+    def __init__(self, workers: int = DRIVE_UPLOAD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="drive-upload")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_permissions = []
+        self.errors = []  # UIスレッドで表示する（ワーカースレッドからは st.* を呼ばない）
+        self.permission_errors = []
+
+    def _service(self):
+        # httplib2 はスレッドセーフでないため、スレッドごとにクライアントを持つ
+        if not hasattr(self._local, "service"):
+            from googleapiclient.discovery import build
+            self._local.service = build('drive', 'v3', credentials=get_credentials(), cache_discovery=False)
+        return self._local.service
+
+    def submit(self, capture: "Capture"):
+        # 戻り値の Future は公開URL（失敗時は ""）を返す。計測は呼び出し元のURLに付ける
+        ctx = current_span_context()
+
+        def upload():
+            with span_context(*(ctx or (None, None))):
+                return self._upload(capture)
+        return self._executor.submit(upload)
+
+    def _upload(self, capture: "Capture") -> str:
+        try:
+            with span("drive_upload"):
+                file = self._service().files().create(
+                    body={'name': capture.name, 'parents': [DRIVE_FOLDER_ID]},
+                    media_body=capture.media_upload(resumable=len(capture.png_bytes) > DRIVE_RESUMABLE_THRESHOLD),
+                    fields='id',
+                    supportsAllDrives=True
+                ).execute()
+        except Exception as e:
+            self.errors.append(f"{capture.name}: {e}")
+            return ""
+        file_id = file.get('id')
+        self._queue_permission(file_id)
+        return f"https://drive.google.com/uc?id={file_id}"
 
-if st.button("判定実行"):
-    urls = [u.strip() for u in urls_input.strip().split('\n') if u.strip()]
-    progress = st.progress(0)
-    status_text = st.empty()
+    def _queue_permission(self, file_id: str):
+        with self._lock:
+            self._pending_permissions.append(file_id)
+            due = len(self._pending_permissions) >= DRIVE_PERMISSION_BATCH
+        if due:
+            self.flush_permissions()
+
+    def share(self, drive_url: str):
+        # 再開時に引き継いだURL用。前のプロセスが権限付与を送る前に止まっていることがあるので付け直す
+        file_id = dict(parse_qsl(urlparse(drive_url).query)).get("id")
+        if file_id:
+            self._queue_permission(file_id)
+
+    def flush_permissions(self):
+        with self._lock:
+            file_ids, self._pending_permissions = self._pending_permissions, []
+        if not file_ids:
+            return
+        service = self._service()
+
+        # 공유드라이브면 실패할 수도 있음 → 기록만 하고 무시
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                self.permission_errors.append(f"{request_id}: {exception}")
+
+        batch = service.new_batch_http_request(callback=on_response)
+        for file_id in file_ids:
+            batch.add(
+                service.permissions().create(fileId=file_id, body={"role": "reader", "type": "anyone"}, supportsAllDrives=True),
+                request_id=file_id,
+            )
+        ctx = current_span_context()
+        try:
+            # まとめて送るので特定のURLには付けない
+            with span_context(ctx[0] if ctx else None), span("drive_permissions"):
+                batch.execute()
+        except Exception as e:
+            self.permission_errors.append(str(e))
+
+    def close(self):
+        # 全アップロードの完了を待ってから残りの権限付与を送る
+        self._executor.shutdown(wait=True)
+        self.flush_permissions()
+
+# GPT判定ステージ
+def stage_gpt(item: dict):
+    item["gpt_opinion"], item["gpt_image_opinion"] = gpt_judge_both(item["maintext"], item["image_desc"], item["capture"])
+    item["preclassified"] = "事前分類" in item["gpt_opinion"]
+
+# 結果キャッシュ（URLと本文ハッシュが同じなら前回の判定結果をそのまま使う）
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "result_cache.sqlite3")
+CACHE_TTL_HOURS = float(os.getenv("CACHE_TTL_HOURS", "168"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "100000"))
+
+def content_hash_of(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest() if text else ""
+
+def is_cacheable_result(result: dict) -> bool:
+    # エラーや未実行の結果はキャッシュしない（次回やり直す）
+    return not any(
+        marker in result[key]
+        for key in ("gpt_opinion", "gpt_image_opinion")
+        for marker in ("GPTエラー", "GPT未実行", "GPT不可")
+    )
+
+class ResultCache:
+    def __init__(self, path: str = CACHE_DB_PATH, ttl_hours: float = CACHE_TTL_HOURS, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, shot_hash TEXT,"
+                " result TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+        self.evict()
+
+    def get(self, url: str, content_hash: str) -> "dict | None":
+        if not content_hash:
+            return None
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT content_hash, result, created_at FROM results WHERE url = ?", (url,)
+            ).fetchone()
+            if not row or row[0] != content_hash or now - row[2] > self.ttl_seconds:
+                return None
+            self._conn.execute("UPDATE results SET last_used = ? WHERE url = ?", (now, url))
+        return json.loads(row[1])
+
+    def put(self, url: str, content_hash: str, result: dict, shot_hash: str = ""):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (url, content_hash, shot_hash, result, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (url, content_hash, shot_hash, json.dumps(result, ensure_ascii=False), now, now),
+            )
+            self._puts += 1
+            due = self._puts % 500 == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        # 期限切れを削除し、上限を超えた分は最近使われていない順に削除
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM results WHERE url IN ("
+                " SELECT url FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
 
-    start_time = time.time()
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    return ResultCache()
+
+# 近似重複（テンプレートが同じページは、判定済みページの結果を流用して OCR・GPT を省く）
+# 本文の SimHash と、スクショ上部の dHash（どちらも64bit）が近ければ同じページとみなす
+NEAR_DUP_DB_PATH = os.getenv("NEAR_DUP_DB_PATH", "near_dup.sqlite3")  # 空にするとこの実行の中だけで探す
+NEAR_DUP_TEXT_BITS = int(os.getenv("NEAR_DUP_TEXT_BITS", "8"))  # 1500字の本文で10文字違うと5〜6bitくらい変わる
+NEAR_DUP_IMAGE_BITS = int(os.getenv("NEAR_DUP_IMAGE_BITS", "10"))
+NEAR_DUP_MIN_CHARS = int(os.getenv("NEAR_DUP_MIN_CHARS", "200"))  # 短い本文（エラーページなど）は対象外
+NEAR_DUP_TTL_HOURS = float(os.getenv("NEAR_DUP_TTL_HOURS", str(CACHE_TTL_HOURS)))
+NEAR_DUP_MEMORY_MAX = int(os.getenv("NEAR_DUP_MEMORY_MAX", "20000"))  # メモリに持つページ数の上限（古い順に手放す）
+# SimHash を (許容bit数 + 1) 本の帯に分けて引く。差が許容bit数以内なら、どれかの帯は必ず完全に一致する
+NEAR_DUP_BANDS = min(64, NEAR_DUP_TEXT_BITS + 1)
+NEAR_DUP_FIELDS = ("gpt_opinion", "gpt_image_opinion", "final_score", "score_explanation", "risk_level", "genre_final")
+
+def simhash(text: str, shingle: int = 4) -> int:
+    import numpy as np
+    # 文字4-gram（重複なし）の blake2b を各bitで多数決
+    text = " ".join(text.split())
+    grams = {text[i:i + shingle] for i in range(max(1, len(text) - shingle + 1))}
+    digests = b"".join(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest() for g in grams)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    return int.from_bytes(np.packbits(bits.sum(axis=0) * 2 > len(grams)).tobytes(), "big")
+
+def dhash(png_bytes: bytes, height: int = BROWSER_WINDOW_SIZE[1]) -> int:
+    import numpy as np
+    # ページの長さが違っても比べられるよう、最初の1画面分だけを見る（縮小していない画像を渡すこと）
+    with Image.open(io.BytesIO(png_bytes)) as img:
+        top = img.crop((0, 0, img.width, min(img.height, height))).convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+        px = np.asarray(top, dtype=np.int16)
+    return int.from_bytes(np.packbits(px[:, 1:] > px[:, :-1]).tobytes(), "big")
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def hash_bands(h: int, count: int = NEAR_DUP_BANDS) -> list:
+    # 64bit をなるべく同じ幅の count 本に分ける（例: 9本なら 8bit が1本と 7bit が8本）
+    edges = [round(64 * i / count) for i in range(count + 1)]
+    return [(h >> lo) & ((1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:])]
+
+def to_signed64(h: "int | None") -> "int | None":
+    # SQLite の INTEGER は符号付き64bit
+    return h - (1 << 64) if h is not None and h >= 1 << 63 else h
+
+class NearDupIndex:
+    # 最近判定したページはメモリから、それ以外は SQLite から探す
+    # プロセスをまたいで使い回すので、メモリ側も期限と件数の上限を守る
+    def __init__(self, path: str = NEAR_DUP_DB_PATH, ttl_hours: float = NEAR_DUP_TTL_HOURS, memory_max: int = NEAR_DUP_MEMORY_MAX):
+        self.ttl_seconds = ttl_hours * 3600
+        self.memory_max = max(1, memory_max)
+        self._lock = threading.Lock()
+        self._entries = {}  # url -> (text_hash, image_hash, verdict, created_at)。追加順に並ぶ
+        self._bands = [{} for _ in range(NEAR_DUP_BANDS)]  # 帯の値 -> url の集合
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            with self._lock, self._conn:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pages ("
+                    " url TEXT PRIMARY KEY, text_hash INTEGER NOT NULL, image_hash INTEGER,"
+                    " verdict TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, value INTEGER NOT NULL, url TEXT NOT NULL)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS bands_value ON bands (band, value)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS bands_url ON bands (url)")
+                expired = time.time() - self.ttl_seconds
+                self._conn.execute("DELETE FROM bands WHERE url IN (SELECT url FROM pages WHERE created_at < ?)", (expired,))
+                self._conn.execute("DELETE FROM pages WHERE created_at < ?", (expired,))
+                # NEAR_DUP_TEXT_BITS を変えると帯の分け方が変わるので、保存済みのハッシュから作り直す
+                if self._conn.execute("PRAGMA user_version").fetchone()[0] != NEAR_DUP_BANDS:
+                    self._conn.execute("DELETE FROM bands")
+                    self._conn.executemany(
+                        "INSERT INTO bands (band, value, url) VALUES (?, ?, ?)",
+                        [
+                            (i, b, url)
+                            for url, text_hash in self._conn.execute("SELECT url, text_hash FROM pages").fetchall()
+                            for i, b in enumerate(hash_bands(text_hash % (1 << 64)))
+                        ],
+                    )
+                    self._conn.execute(f"PRAGMA user_version = {NEAR_DUP_BANDS}")
+
+    @staticmethod
+    def _compare(text_hash: int, image_hash: "int | None", other_text: int, other_image: "int | None") -> "tuple | None":
+        # スクショはどちらにも有るか、どちらにも無い場合だけ同じページとみなす
+        text_bits = hamming(text_hash, other_text)
+        if text_bits > NEAR_DUP_TEXT_BITS or (image_hash is None) != (other_image is None):
+            return None
+        image_bits = hamming(image_hash, other_image) if image_hash is not None else None
+        if image_bits is not None and image_bits > NEAR_DUP_IMAGE_BITS:
+            return None
+        return text_bits, image_bits
+
+    def _closest(self, text_hash: int, image_hash: "int | None", candidates) -> "dict | None":
+        best = best_key = None
+        for url, other_text, other_image, verdict in candidates:
+            distance = self._compare(text_hash, image_hash, other_text, other_image)
+            if distance is None:
+                continue
+            key = (distance[0], distance[1] or 0)
+            if best is None or key < best_key:
+                best, best_key = {"url": url, "text_bits": distance[0], "image_bits": distance[1], "result": verdict}, key
+        return best
+
+    def find(self, text_hash: int, image_hash: "int | None") -> "dict | None":
+        bands = hash_bands(text_hash)
+        with self._lock:
+            urls = set().union(*(self._bands[i].get(b, ()) for i, b in enumerate(bands)))
+            expired = time.time() - self.ttl_seconds
+            best = self._closest(text_hash, image_hash, [
+                (url, *self._entries[url][:3]) for url in urls if self._entries[url][3] >= expired
+            ])
+            if best is not None or self._conn is None:
+                return best
+            # 判定結果は一番近いものだけ読む
+            rows = self._conn.execute(
+                "SELECT DISTINCT p.url, p.text_hash, p.image_hash FROM bands b JOIN pages p ON p.url = b.url"
+                " WHERE (" + " OR ".join("(b.band = ? AND b.value = ?)" for _ in bands) + ") AND p.created_at >= ?",
+                (*(v for pair in enumerate(bands) for v in pair), time.time() - self.ttl_seconds),
+            ).fetchall()
+            best = self._closest(text_hash, image_hash, [
+                (url, t % (1 << 64), None if i is None else i % (1 << 64), None) for url, t, i in rows
+            ])
+            if best is not None:
+                best["result"] = json.loads(self._conn.execute("SELECT verdict FROM pages WHERE url = ?", (best["url"],)).fetchone()[0])
+        return best
+
+    def _forget(self, url: str):
+        # メモリからだけ消す（SQLite には残る）
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        for i, b in enumerate(hash_bands(entry[0])):
+            urls = self._bands[i].get(b)
+            if urls is not None:
+                urls.discard(url)
+                if not urls:
+                    del self._bands[i][b]
+
+    def add(self, url: str, text_hash: int, image_hash: "int | None", result: dict):
+        verdict = {key: result[key] for key in NEAR_DUP_FIELDS}
+        bands = hash_bands(text_hash)
+        with self._lock:
+            self._forget(url)
+            self._entries[url] = (text_hash, image_hash, verdict, time.time())
+            for i, b in enumerate(bands):
+                self._bands[i].setdefault(b, set()).add(url)
+            while len(self._entries) > self.memory_max:
+                self._forget(next(iter(self._entries)))
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO pages (url, text_hash, image_hash, verdict, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (url, to_signed64(text_hash), to_signed64(image_hash), json.dumps(verdict, ensure_ascii=False), time.time()),
+                    )
+                    self._conn.execute("DELETE FROM bands WHERE url = ?", (url,))
+                    self._conn.executemany("INSERT INTO bands (band, value, url) VALUES (?, ?, ?)", [(i, b, url) for i, b in enumerate(bands)])
 
-    for idx, url in enumerate(urls, 1):
-        try:
-            maintext, image_desc, shot_path, html, ocr_text = crawl_with_ocr(url, idx)
+@st.cache_resource
+def get_near_dup_index() -> NearDupIndex:
+    return NearDupIndex()
+
+def find_near_duplicate(item: dict, index: NearDupIndex):
+    # レンダリング直後に呼ぶ。見つかれば OCR・GPT を飛ばし、流したOCRは取り消す
+    text = item["maintext"]
+    if len(text) < NEAR_DUP_MIN_CHARS:
+        return
+    with span("near_dup"):
+        item["text_hash"] = simhash(text)
+        capture = item.get("capture")
+        # タイル撮影なら先頭タイルで取った値を使う（全体スクショは元の解像度なのでそのまま）
+        first_screen_hash = item.pop("first_screen_hash", None)
+        item["image_hash"] = None if not capture else first_screen_hash if first_screen_hash is not None else dhash(capture.png_bytes)
+        match = index.find(item["text_hash"], item["image_hash"])
+    if match is None:
+        return
+    item["near_dup"] = match
+    item["skip_stages"] = {"ocr", "gpt"}
+    for future in item.pop("ocr_futures", None) or []:
+        future.cancel()
+    item["ocr_text"] = ""
+
+def evaluate_near_dup(item: dict) -> dict:
+    # 流用するのはジャンル・スコア・GPTの判定だけで、本文・キーワード・スクショはこのページのもの
+    match = item["near_dup"]
+    capture = item.get("capture")
+    item["shot_hash"] = capture.sha256 if capture else ""
+    keyword_result = judge_keywords_by_count(item["maintext"] + " " + item["image_desc"], current_rules().matcher)
+    image_note = f" / 画像 {match['image_bits']}bit差" if match["image_bits"] is not None else ""
+    note = f"[判定段階]: {CASCADE_TIER_LABELS['near_dup']}（{match['url']} の判定を流用・本文 {match['text_bits']}bit差{image_note}）"
+    explanation = match["result"]["score_explanation"]
+    explanation = re.sub(r"\[判定段階\]: [^\n]*", lambda _: note, explanation) if "[判定段階]" in explanation else f"{explanation}\n{note}"
+    return {
+        **match["result"],
+        # T列にも印を付ける（preclassifier の学習データから除くため）
+        "gpt_opinion": f"[近似重複] {match['url']} の判定を流用\n{match['result']['gpt_opinion']}",
+        "maintext": item["maintext"][:1200],
+        "drive_url": "" if capture else "結果なし",
+        "keyword_summary": "\n".join(f"{genre}（{count}個）: {', '.join(matched)}" for genre, count, matched in keyword_result),
+        "score_explanation": explanation,
+        "decided_by": "near_dup",
+    }
+
+def near_dup_clusters(source_urls) -> list:
+    # 流用元ごとの件数（流用元自身を含む）。source_urls は流用した item の near_dup["url"]
+    sizes = {}
+    for url in source_urls:
+        sizes[url] = sizes.get(url, 1) + 1
+    return [{"代表URL": url, "件数": size} for url, size in sorted(sizes.items(), key=lambda kv: -kv[1])]
+
+# 段階判定（URLパターン → HTTPステータス → HTMLキーワードの安い順に見て、確定したらレンダリング・OCR・GPTを省く）
+# 既定は url,status（空にすると全件フル判定）
+# "keywords" は明示的に指定した時だけ使う。通常のスコアではキーワードだけで Unsafe（11点以上）にはならないが、
+# 有効にすると危険ジャンルのキーワードが CASCADE_KEYWORD_MIN 個以上一致したページはスクショ・GPT無しで Unsafe にする
+CASCADE_TIERS = [t.strip() for t in os.getenv("CASCADE_TIERS", "url,status").split(",") if t.strip()]
+CASCADE_KEYWORD_MIN = int(os.getenv("CASCADE_KEYWORD_MIN", "8"))
+CASCADE_STATUS_CODES = {int(c) for c in os.getenv("CASCADE_STATUS_CODES", "404,410,451").split(",") if c.strip()}
+UNSAFE_GENRES = ['アダルト', '悪質CGM', '著作権侵害', 'ヘイト', '危険物', 'グロテスク']
+CASCADE_TIER_LABELS = {"url": "URLパターン", "status": "HTTPステータス", "keywords": "HTMLキーワード（キーワードのみで Unsafe とする設定）", "full": "フル判定（スクショ・OCR・GPT）", "near_dup": "近似重複"}
+
+def is_unsafe_genre(genre: str) -> bool:
+    # スコア計算と同じく部分一致（「ヘイト/センシティブ」も危険ジャンル）
+    return bool(genre) and any(g in genre for g in UNSAFE_GENRES)
+
+def cascade_by_url(item: dict) -> "dict | None":
+    genre, matched = judge_genre_by_patterns([item["url"]], current_rules().matcher)
+    if is_unsafe_genre(genre):
+        return {"tier": "url", "genre": genre, "score": 15, "reason": f"パターン: {matched}"}
+    return None
 
-            gpt_image_opinion = gpt_judge_image(shot_path, image_desc) if shot_path and os.path.isfile(shot_path) else "画像未解析"
-            gpt_opinion = gpt_judge_genre(maintext, image_desc, GENRE_KEYWORDS) if GPT_API_KEY else "GPT未実行"
+def cascade_by_status(item: dict) -> "dict | None":
+    # 403 などはブラウザなら見られることがあるので、ページが無いと分かるものだけ
+    doc = item.get("doc")
+    if doc is not None and doc.status_code in CASCADE_STATUS_CODES:
+        return {"tier": "status", "genre": "閲覧不可", "score": 5, "reason": f"HTTP {doc.status_code}"}
+    return None
 
-            if "要確認" in gpt_image_opinion or "判定できません" in gpt_image_opinion or "未解析" in gpt_image_opinion:
-                preferred_opinion = gpt_opinion
+def cascade_by_keywords(item: dict) -> "dict | None":
+    # キーワードだけで Unsafe とする運用ルール（CASCADE_TIERS に keywords を入れた時だけ）
+    doc = item.get("doc")
+    if doc is None or not doc.clean_text:
+        return None
+    matches = judge_keywords_by_count(doc.clean_text + " " + doc.image_desc, current_rules().matcher)
+    unsafe = [(genre, count, matched) for genre, count, matched in matches if is_unsafe_genre(genre)]
+    if not unsafe or sum(count for _, count, _ in unsafe) < CASCADE_KEYWORD_MIN:
+        return None
+    genre, count, matched = max(unsafe, key=lambda m: m[1])
+    return {"tier": "keywords", "genre": genre, "score": 15, "reason": f"{genre}（{count}個）: {', '.join(matched[:5])}"}
+
+CASCADE_STEPS = {"url": cascade_by_url, "status": cascade_by_status, "keywords": cascade_by_keywords}
+
+def decide_by_cascade(item: dict, tiers) -> bool:
+    # CASCADE_TIERS で有効な段階だけ見る。確定したら item["cascade"] に残し、残りの重い段階を飛ばす
+    with span("cascade"):
+        for tier in tiers:
+            if tier not in CASCADE_TIERS:
+                continue
+            decision = CASCADE_STEPS[tier](item)
+            if decision is not None:
+                item["cascade"] = decision
+                item["skip_stages"] = {"render", "ocr", "gpt"}
+                return True
+    return False
+
+def evaluate_cascade(item: dict) -> dict:
+    # 段階判定で確定した URL の結果（スクショとGPTは無し。GPT未実行なのでキャッシュには残らない）
+    decision = item["cascade"]
+    doc = item.get("doc")
+    maintext = doc.clean_text if doc else ""
+    keyword_result = judge_keywords_by_count(maintext + " " + doc.image_desc, current_rules().matcher) if doc else []
+    keyword_summary = "\n".join(f"{genre}（{count}個）: {', '.join(matched)}" for genre, count, matched in keyword_result)
+    site_origin = "日本サイト" if is_japanese_site_by_html_or_ocr(item["url"], doc or "", "") else "海外サイト"
+    label = CASCADE_TIER_LABELS[decision["tier"]]
+    score = decision["score"]
+    skipped = f"GPT未実行（{label}で確定）"
+    return {
+        "maintext": maintext[:1200],
+        "drive_url": "結果なし",
+        "gpt_opinion": skipped,
+        "gpt_image_opinion": skipped,
+        "keyword_summary": keyword_summary,
+        "final_score": score,
+        "score_explanation": f"{site_origin}\n[判定段階]: {label}（{decision['reason']}）\n[最終スコア]: {score}/15",
+        "risk_level": "Unsafe" if score >= 11 else "NotSafe" if score >= 5 else "Safe",
+        "genre_final": decision["genre"],
+        "decided_by": decision["tier"],
+    }
+
+def cascade_counts(items) -> dict:
+    # 段階ごとに確定した件数（表示用）
+    counts = {}
+    for item in items:
+        if item.get("cascade"):
+            tier = item["cascade"]["tier"]
+            counts[tier] = counts.get(tier, 0) + 1
+    return counts
+
+# スコア計算（シートに書く値をまとめて返す）
+def evaluate_item(item: dict) -> dict:
+    if item.get("cascade"):
+        return evaluate_cascade(item)
+    if item.get("near_dup"):
+        return evaluate_near_dup(item)
+    url = item["url"]
+    capture = item["capture"]
+    maintext = item["maintext"]
+    image_desc = item["image_desc"]
+    gpt_opinion = item["gpt_opinion"]
+    gpt_image_opinion = item["gpt_image_opinion"]
+
+    if "要確認" in gpt_image_opinion or "判定できません" in gpt_image_opinion or "未解析" in gpt_image_opinion:
+        preferred_opinion = gpt_opinion
+    else:
+        preferred_opinion = gpt_image_opinion
+
+    # Drive のURLは stage_io で埋める
+    drive_url = "" if capture else "結果なし"
+    item["shot_hash"] = capture.sha256 if capture else ""
+    keyword_result = judge_keywords_by_count(maintext + " " + image_desc, current_rules().matcher)
+    keyword_summary = "\n".join(f"{genre}（{count}個）: {', '.join(matched)}" for genre, count, matched in keyword_result)
+
+    ocr_kw_count = sum(len(matched) for _, _, matched in keyword_result)
+    ocr_point = 5 if ocr_kw_count >= 5 else 4 if ocr_kw_count >= 4 else 3 if ocr_kw_count >= 3 else 2 if ocr_kw_count >= 1 else 0
+    gpt_point = 5 if any(g in gpt_opinion for g in ['アダルト', '悪質CGM', '著作権侵害', 'ヘイト', '危険物', 'グロテスク']) else 0
+    gpt_image_point = 0
+    genre_match = re.search(r"\[ジャンル\]:\s*(.+?)\s*(/|\n|$)", gpt_image_opinion)
+    if genre_match and genre_match.group(1).strip() in ['閲覧不可', '認証が必要', 'アダルト', '悪質CGM', '著作権侵害', 'ヘイト', '危険物', 'グロテスク']:
+        gpt_image_point = 5
+
+    final_score = min(ocr_point + gpt_point + gpt_image_point, 15)
+
+    site_origin = "日本サイト" if is_japanese_site_by_html_or_ocr(url, item.get("doc") or "", item["ocr_text"]) else "海外サイト"
+
+    score_explanation = (
+        f"{site_origin}\n"
+        f"キーワードスコア: {ocr_point}点\n"
+        f"GPT本文スコア: {gpt_point}点\n"
+        f"GPT画像スコア: {gpt_image_point}点\n"
+        f"[判定段階]: {CASCADE_TIER_LABELS['full']}\n"
+        f"[最終スコア]: {final_score}/15"
+    )
+
+    risk_level = "Unsafe" if final_score >= 11 else "NotSafe" if final_score >= 5 else "Safe"
+
+    # --- [Y列: ジャンル分類] 反映処理 --- #
+    genre_final_match = re.search(r"\[ジャンル\]:\s*([^\n]+)", preferred_opinion)
+    if genre_final_match:
+        genre_final = genre_final_match.group(1).strip()
+        if any(x in genre_final for x in ["要確認", "該当なし", "カテゴリー該当なし"]):
+            genre_final = "カテゴリー該当なし"
+    else:
+        genre_final = "カテゴリー該当なし"
+
+    return {
+        "maintext": maintext[:1200],
+        "drive_url": drive_url,
+        "gpt_opinion": gpt_opinion,
+        "gpt_image_opinion": gpt_image_opinion,
+        "keyword_summary": keyword_summary,
+        "final_score": final_score,
+        "score_explanation": score_explanation,
+        "risk_level": risk_level,
+        "genre_final": genre_final,
+        "decided_by": "full",
+    }
+
+def result_to_columns(result: dict) -> dict:
+    return {
+        2: datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # B
+        18: result["maintext"],                         # R
+        19: f'=IMAGE("{result["drive_url"]}", 1)',      # S
+        20: result["gpt_opinion"],                      # T
+        21: result["gpt_image_opinion"],                # U
+        22: result["keyword_summary"],                  # V
+        23: result["score_explanation"],                # W
+        24: result["risk_level"],                       # X
+        25: result["genre_final"],                      # ✅ Y列
+    }
+
+# Drive/Sheets 書き込みステージ
+def stage_io(item: dict, writer: "SheetWriter | None", cache: "ResultCache | None" = None, uploader: "DriveUploader | None" = None, on_written=None, dup_index: "NearDupIndex | None" = None):
+    # writer が None の時はシートに書かず item["result"] に残すだけ（batch_cli の JSONL 出力用）
+    # on_written はその行の最後の書き込みがシートに反映された後に呼ばれる
+    url = item["url"]
+    result = item.get("cached_result")
+    if result is not None:
+        item["result"] = result
+        if writer is not None:
+            writer.queue(url, result_to_columns(result), on_written)
+        return
+
+    def remember(result):
+        if cache is not None and item.get("content_hash") and is_cacheable_result(result):
+            cache.put(url, item["content_hash"], result, item.get("shot_hash", ""))
+
+    result = evaluate_item(item)
+    item["result"] = result
+    if dup_index is not None and item.get("text_hash") is not None and not item.get("near_dup") and is_cacheable_result(result):
+        dup_index.add(url, item["text_hash"], item.get("image_hash"), result)
+    capture = item.get("capture")
+    if capture is not None and item.get("drive_url"):
+        # 再開時など、アップロード済みならそのURLを使う
+        result["drive_url"] = item["drive_url"]
+        if uploader is not None:
+            uploader.share(item["drive_url"])
+    elif capture is not None and uploader is not None:
+        # アップロード完了を待たずに他の列を書き、S列は完了後に埋める
+        if writer is not None:
+            columns = result_to_columns(result)
+            del columns[19]
+            writer.queue(url, columns)
+
+        # item["upload"] は S列の書き込み依頼とキャッシュ保存まで済んだら完了する（失敗は例外として残す）
+        # done-callback の中の例外は concurrent.futures が握りつぶすので、ここで item のエラーにする
+        written = Future()
+
+        def on_uploaded(future):
+            try:
+                result["drive_url"] = future.result() if future.exception() is None else ""
+                if writer is not None:
+                    writer.queue(url, {19: result_to_columns(result)[19]}, on_written)
+                if result["drive_url"]:
+                    remember(result)  # アップロードに失敗した結果は残さず、次回アップし直す
+            except Exception as e:
+                item["error"] = f"io: {e}"
+                written.set_exception(e)
             else:
-                preferred_opinion = gpt_image_opinion
+                written.set_result(result["drive_url"])
+        item["upload"] = written
+        uploader.submit(capture).add_done_callback(on_uploaded)
+        return
+
+    if writer is None:
+        if capture is None or result["drive_url"]:
+            remember(result)  # スクショのURLが無い結果はシートに流用できないので残さない
+        return
+    if capture is not None and not result["drive_url"]:
+        result["drive_url"] = upload_to_drive(capture, capture.name)
+    writer.queue(url, result_to_columns(result), on_written)
+    remember(result)
+
+# Sheets 書き込み（URL→行インデックスを先読みし、まとめて batch_update）
+SHEET_URL_COLUMN = os.getenv("SHEET_URL_COLUMN", "")  # 例: "A"。未設定ならシート全体からURLを探す
+SHEET_FLUSH_ROWS = int(os.getenv("SHEET_FLUSH_ROWS", "20"))
+SHEET_FLUSH_SECONDS = float(os.getenv("SHEET_FLUSH_SECONDS", "10"))
+SHEET_MAX_RETRIES = int(os.getenv("SHEET_MAX_RETRIES", "5"))
+
+def call_sheets_with_backoff(fn, *args, **kwargs):
+    import gspread
+    for attempt in range(SHEET_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status not in (429, 500, 503) or attempt >= SHEET_MAX_RETRIES:
+                raise
+            time.sleep(min(2 ** attempt, 64) + random.random())
+
+class SheetWriter:
+    def __init__(self, worksheet, flush_rows: int = SHEET_FLUSH_ROWS, flush_seconds: float = SHEET_FLUSH_SECONDS, recorder: "SpanRecorder | None" = None):
+        self.worksheet = worksheet
+        self.recorder = recorder
+        self.flush_rows = max(1, flush_rows)
+        self.flush_seconds = flush_seconds
+        self.row_index = self._build_row_index()
+        self._pending = {}  # row -> {col: value}
+        self._callbacks = {}  # row -> [書き込み完了後に呼ぶ関数]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.time()
+        self._closed = threading.Event()
+        self._ticker = threading.Thread(target=self._tick, daemon=True)
+        self._ticker.start()
+
+    def _build_row_index(self) -> dict:
+        # 正規化したURL -> そのURLがある全ての行（同じページが複数行にあれば全部に書く）
+        from gspread.utils import a1_to_rowcol
+        index = {}
+        if SHEET_URL_COLUMN:
+            col = int(SHEET_URL_COLUMN) if SHEET_URL_COLUMN.isdigit() else a1_to_rowcol(f"{SHEET_URL_COLUMN}1")[1]
+            for row, value in enumerate(call_sheets_with_backoff(self.worksheet.col_values, col), 1):
+                if value:
+                    index.setdefault(normalize_url(value), {})[row] = None
+        else:
+            for row, values in enumerate(call_sheets_with_backoff(self.worksheet.get_all_values), 1):
+                for value in values:
+                    if value:
+                        index.setdefault(normalize_url(value), {})[row] = None
+        return {key: list(rows) for key, rows in index.items()}
+
+    def queue(self, url: str, values: dict, on_written=None):
+        rows = self.row_index.get(normalize_url(url))
+        if not rows:
+            raise ValueError(f"シートにURLが見つかりません: {url}")
+        with self._lock:
+            for row in rows:
+                self._pending.setdefault(row, {}).update(values)
+            if on_written is not None:
+                # 同じ flush でまとめて書かれるので、最後の行にだけ付ける
+                self._callbacks.setdefault(rows[-1], []).append(on_written)
+            due = len(self._pending) >= self.flush_rows
+        if due:
+            try:
+                self.flush()
+            except Exception:
+                # 失敗した行はバッファに戻っていて次回の flush（最後は close）で再送されるので、
+                # たまたま flush を起こした item のエラーにはしない
+                pass
+
+    @staticmethod
+    def _to_ranges(row: int, cols: dict) -> list:
+        # 連続した列は1つのレンジにまとめる（B と R:Y など）
+        from gspread.utils import rowcol_to_a1
+        data = []
+        run_start, run_values = None, []
+        for col in sorted(cols):
+            if run_start is not None and col == run_start + len(run_values):
+                run_values.append(cols[col])
+                continue
+            if run_start is not None:
+                data.append((run_start, run_values))
+            run_start, run_values = col, [cols[col]]
+        if run_start is not None:
+            data.append((run_start, run_values))
+        return [
+            {
+                "range": f"{rowcol_to_a1(row, start)}:{rowcol_to_a1(row, start + len(vals) - 1)}",
+                "values": [vals],
+            }
+            for start, vals in data
+        ]
 
-            drive_url = upload_to_drive(shot_path, os.path.basename(shot_path)) if shot_path and os.path.isfile(shot_path) else "結果なし"
-            keyword_result = judge_keywords_by_count(maintext + " " + image_desc, GENRE_KEYWORDS)
-            keyword_summary = "\n".join(f"{genre}（{count}個）: {', '.join(matched)}" for genre, count, matched in keyword_result)
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                callbacks, self._callbacks = self._callbacks, {}
+                self._last_flush = time.time()
+            if not pending:
+                return
+            data = []
+            for row, cols in sorted(pending.items()):
+                data.extend(self._to_ranges(row, cols))
+            try:
+                with span_context(self.recorder), span("sheet_write"):
+                    # gspread の batch_update は各 range にシート名を書き足すので、リトライのたびに作り直して渡す
+                    call_sheets_with_backoff(
+                        lambda: self.worksheet.batch_update([dict(entry) for entry in data], value_input_option="USER_ENTERED")
+                    )
+            except Exception:
+                # 失敗分はバッファに戻す（後から来た値を優先）
+                with self._lock:
+                    for row, cols in pending.items():
+                        self._pending[row] = {**cols, **self._pending.get(row, {})}
+                    for row, fns in callbacks.items():
+                        self._callbacks[row] = fns + self._callbacks.get(row, [])
+                raise
+            for fns in callbacks.values():
+                for fn in fns:
+                    fn()
+
+    def _tick(self):
+        while not self._closed.wait(1):
+            if self._pending and time.time() - self._last_flush >= self.flush_seconds:
+                try:
+                    self.flush()
+                except Exception:
+                    pass  # 次回の flush で再送
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+def cleanup_item(item: dict):
+    # 結果表示用に item は残すので、パース結果などの重いものは手放す
+    item.pop("doc", None)
+    item.pop("html", None)
+    item.pop("capture", None)
+
+# パイプライン実行（ステージごとにワーカーとキューを持つ）
+def build_pipeline_stages(writer: "SheetWriter | None", cache: "ResultCache | None" = None, uploader: "DriveUploader | None" = None, dup_index: "NearDupIndex | None" = None) -> list:
+    return [
+        ("fetch", lambda item: stage_fetch(item, cache)),
+        ("render", lambda item: stage_render(item, dup_index)),
+        ("ocr", stage_ocr),
+        ("gpt", stage_gpt),
+        ("io", lambda item: stage_io(item, writer, cache, uploader, dup_index=dup_index)),
+    ]
 
-            ocr_kw_count = sum(len(matched) for _, _, matched in keyword_result)
-            ocr_point = 5 if ocr_kw_count >= 5 else 4 if ocr_kw_count >= 4 else 3 if ocr_kw_count >= 3 else 2 if ocr_kw_count >= 1 else 0
-            gpt_point = 5 if any(g in gpt_opinion for g in ['アダルト', '悪質CGM', '著作権侵害', 'ヘイト', '危険物', 'グロテスク']) else 0
-            gpt_image_point = 0
-            genre_match = re.search(r"\[ジャンル\]:\s*(.+?)\s*(/|\n|$)", gpt_image_opinion)
-            if genre_match and genre_match.group(1).strip() in ['閲覧不可', '認証が必要', 'アダルト', '悪質CGM', '著作権侵害', 'ヘイト', '危険物', 'グロテスク']:
-                gpt_image_point = 5
+PIPELINE_DEFAULT_WORKERS = {"fetch": 4, "render": BROWSER_POOL_SIZE, "ocr": 2, "gpt": 4, "io": 2}
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+def load_pipeline_workers() -> dict:
+    return {
+        name: max(1, int(os.getenv(f"PIPELINE_{name.upper()}_WORKERS", str(default))))
+        for name, default in PIPELINE_DEFAULT_WORKERS.items()
+    }
+
+class UrlPipeline:
+    def __init__(self, stages, workers: dict, queue_size: int = PIPELINE_QUEUE_SIZE, recorder: "SpanRecorder | None" = None):
+        self.stages = stages
+        self.workers = workers
+        self.recorder = recorder
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        self.done = queue.Queue()
+        self._stop = threading.Event()
+        self._fed = 0
+        self._feed_done = threading.Event()
+
+    def _next_queue(self, i: int) -> queue.Queue:
+        return self.queues[i + 1] if i + 1 < len(self.stages) else self.done
+
+    def _worker(self, i: int):
+        name, fn = self.stages[i]
+        q = self.queues[i]
+        while True:
+            try:
+                item = q.get(timeout=0.2)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            if self._stop.is_set() and not item.get("error"):
+                item["error"] = "中断されました"
+                item["interrupted"] = True
+            if not item.get("error") and name not in item.get("skip_stages", ()):
+                started = time.time()
+                with span_context(self.recorder, item["url"]):
+                    try:
+                        with span(f"stage.{name}"):
+                            fn(item)
+                    except Exception as e:
+                        item["error"] = f"{name}: {e}"
+                item["timings"][name] = time.time() - started
+            self._next_queue(i).put(item)
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    break
+                self.queues[0].put(item)
+                self._fed += 1
+        finally:
+            self._feed_done.set()
+
+    def run(self, items):
+        # items はリストでもジェネレーターでもよい（大量のURLを全部メモリに載せなくて済む）
+        # Streamlitのスレッドからもst.warning等が表示できるようにコンテキストを引き継ぐ
+        ctx = get_script_run_ctx()
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for i, (name, _) in enumerate(self.stages):
+            for _ in range(self.workers.get(name, 1)):
+                threads.append(threading.Thread(target=self._worker, args=(i,), daemon=True))
+        for t in threads:
+            add_script_run_ctx(t, ctx)
+            t.start()
+        try:
+            received = 0
+            while not (self._feed_done.is_set() and received >= self._fed):
+                try:
+                    item = self.done.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                received += 1
+                yield item
+        finally:
+            self._stop.set()
+
+# 1件だけ全段階（書き込み以外）をこのスレッドで順に実行して cProfile を取る
+# OCRは子プロセス、GPTはイベントループのスレッドで動くので、それぞれ待ち時間としてだけ現れる
+def profile_url(url: str, readiness: str = "", limit: int = 40) -> tuple[str, bytes, SpanRecorder]:
+    import cProfile, pstats, tempfile
+    item = {"idx": 0, "url": url, "readiness": readiness, "timings": {}}
+    recorder = SpanRecorder()
+    profiler = cProfile.Profile()
+    with span_context(recorder, url):
+        profiler.enable()
+        try:
+            for name, fn in (("fetch", stage_fetch), ("render", stage_render), ("ocr", stage_ocr), ("gpt", stage_gpt)):
+                if name in item.get("skip_stages", ()):
+                    continue
+                with span(f"stage.{name}"):
+                    fn(item)
+            evaluate_item(item)
+        finally:
+            profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "profile.prof")
+        profiler.dump_stats(path)
+        with open(path, "rb") as f:
+            raw = f.read()
+    return out.getvalue(), raw, recorder
+
+# ジョブキュー（URLごとに各段階の結果を SQLite に残し、中断しても続きから再開できる）
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.sqlite3")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))  # この間ハートビートが無ければ他のワーカーが引き取る
+JOB_LEASE_BATCH = int(os.getenv("JOB_LEASE_BATCH", "8"))
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "14"))  # これより古いジョブは削除（0以下で無期限）
+
+# チェックポイント名 -> 保存する item のキー
+CHECKPOINT_FIELDS = {
+    "crawl": ("content_hash", "maintext", "image_desc", "html", "ocr_scope", "text_hash", "image_hash", "near_dup"),
+    "ocr": ("maintext", "image_desc", "ocr_text", "ocr_seconds"),
+    "gpt_text": ("gpt_opinion",),
+    "gpt_image": ("gpt_image_opinion",),
+    "upload": ("drive_url",),
+}
+
+class JobStore:
+    def __init__(self, path: str = JOB_DB_PATH, max_attempts: int = JOB_MAX_ATTEMPTS, lease_seconds: float = JOB_LEASE_SECONDS, retention_days: float = JOB_RETENTION_DAYS):
+        self.max_attempts = max(1, max_attempts)
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_days * 86400
+        self._lock = threading.Lock()
+        self._workers = set()  # このプロセスで動いているワーカーID（リースを延長する）
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, created_at REAL NOT NULL, readiness TEXT, total INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " job_id TEXT NOT NULL, idx INTEGER NOT NULL, url TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+                " lease_owner TEXT, lease_until REAL, error TEXT,"
+                " checkpoints TEXT NOT NULL DEFAULT '{}', capture BLOB, capture_name TEXT, result TEXT,"
+                " updated_at REAL, PRIMARY KEY (job_id, idx))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (job_id, status)")
+        self.evict()
+        self._heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self._heartbeat.start()
+
+    def evict(self):
+        # 保持期間を過ぎたジョブをタスクごと削除
+        if self.retention_seconds <= 0:
+            return
+        expired = time.time() - self.retention_seconds
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tasks WHERE job_id IN (SELECT id FROM jobs WHERE created_at < ?)", (expired,))
+            self._conn.execute("DELETE FROM jobs WHERE created_at < ?", (expired,))
+
+    def create_job(self, urls: list, readiness: str = "") -> str:
+        self.evict()
+        urls = dedupe_urls(urls)
+        job_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs (id, created_at, readiness, total) VALUES (?, ?, ?, ?)", (job_id, now, readiness, len(urls)))
+            self._conn.executemany(
+                "INSERT INTO tasks (job_id, idx, url, updated_at) VALUES (?, ?, ?, ?)",
+                ((job_id, idx, url, now) for idx, url in enumerate(urls, 1)),
+            )
+        return job_id
+
+    def list_jobs(self, limit: int = 20) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, created_at, readiness, total FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"id": r[0], "created_at": r[1], "readiness": r[2], "total": r[3]} for r in rows]
+
+    def progress(self, job_id: str) -> dict:
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        with self._lock:
+            for status, count in self._conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+            ):
+                counts[status] = count
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def failures(self, job_id: str, limit: int = 100) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, url, attempts, error FROM tasks WHERE job_id = ? AND status = 'failed' ORDER BY idx LIMIT ?",
+                (job_id, limit),
+            ).fetchall()
+        return [{"No.": r[0], "URL": r[1], "試行回数": r[2], "エラー": r[3]} for r in rows]
+
+    def retry_failed(self, job_id: str) -> int:
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, error = NULL, updated_at = ?"
+                " WHERE job_id = ? AND status = 'failed'",
+                (time.time(), job_id),
+            ).rowcount
+
+    def open_worker(self) -> str:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._workers.add(worker_id)
+        return worker_id
+
+    def close_worker(self, worker_id: str):
+        # 書き込みまで終わらなかったタスクは、試行回数を増やさずに戻す
+        with self._lock, self._conn:
+            self._workers.discard(worker_id)
+            self._conn.execute(
+                "UPDATE tasks SET status = 'pending', lease_owner = NULL, lease_until = NULL, attempts = MAX(attempts - 1, 0)"
+                " WHERE lease_owner = ? AND status = 'leased'",
+                (worker_id,),
+            )
 
-            final_score = min(ocr_point + gpt_point + gpt_image_point, 15)
+    def _renew_leases(self):
+        while True:
+            time.sleep(max(1.0, self.lease_seconds / 4))
+            with self._lock:
+                workers = list(self._workers)
+                if not workers:
+                    continue
+                with self._conn:
+                    self._conn.execute(
+                        f"UPDATE tasks SET lease_until = ? WHERE status = 'leased' AND lease_owner IN ({','.join('?' * len(workers))})",
+                        (time.time() + self.lease_seconds, *workers),
+                    )
+
+    def lease(self, job_id: str, worker_id: str, limit: int = JOB_LEASE_BATCH) -> list:
+        # 複数プロセスから同時に呼ばれても同じタスクを二重に取らないよう、書き込みロックを取ってから選ぶ
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'failed', error = COALESCE(error, 'リトライ上限に達しました'), updated_at = ?"
+                    " WHERE job_id = ? AND attempts >= ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))",
+                    (now, job_id, self.max_attempts, now),
+                )
+                rows = self._conn.execute(
+                    "SELECT idx, url, checkpoints, capture, capture_name FROM tasks"
+                    " WHERE job_id = ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))"
+                    " ORDER BY idx LIMIT ?",
+                    (job_id, now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE tasks SET status = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+                    " WHERE job_id = ? AND idx = ?",
+                    ((worker_id, now + self.lease_seconds, now, job_id, row[0]) for row in rows),
+                )
+                readiness = self._conn.execute("SELECT readiness FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return [self._restore(job_id, readiness[0] if readiness else "", *row) for row in rows]
+
+    @staticmethod
+    def _restore(job_id: str, readiness: str, idx: int, url: str, checkpoints: str, capture: bytes, capture_name: str) -> dict:
+        item = {"idx": idx, "url": url, "readiness": readiness, "timings": {}, "job_id": job_id}
+        checkpoints = json.loads(checkpoints)
+        for name in CHECKPOINT_FIELDS:  # 後の段階の値で上書きされる順に戻す
+            item.update(checkpoints.get(name, {}))
+        item["checkpoints"] = set(checkpoints)
+        if "crawl" in checkpoints:
+            item["doc"] = PageDocument(item["html"]) if item.get("html") else None
+            item["capture"] = Capture(capture, capture_name) if capture else None
+        if item.get("near_dup"):
+            item["skip_stages"] = {"ocr", "gpt"}
+        return item
+
+    def items(self, job_id: str, worker_id: str):
+        # パイプラインに流す item を少しずつリースする（他のワーカーと取り合っても重ならない）
+        while True:
+            items = self.lease(job_id, worker_id)
+            if not items:
+                return
+            yield from items
+
+    def checkpoint(self, item: dict, name: str):
+        data = {key: item.get(key) for key in CHECKPOINT_FIELDS[name]}
+        capture = item.get("capture") if name == "crawl" else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET checkpoints = json_set(checkpoints, '$.' || ?, json(?)), updated_at = ?"
+                + (", capture = ?, capture_name = ?" if capture is not None else "")
+                + " WHERE job_id = ? AND idx = ?",
+                (name, json.dumps(data, ensure_ascii=False), time.time())
+                + ((capture.png_bytes, capture.name) if capture is not None else ())
+                + (item["job_id"], item["idx"]),
+            )
+        item.setdefault("checkpoints", set()).add(name)
+
+    def complete(self, item: dict):
+        # 書き込みまで終わったら、途中結果（HTML・本文・OCR）とスクショは手放す
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET status = 'done', lease_owner = NULL, lease_until = NULL, error = NULL,"
+                " checkpoints = '{\"sheet\": true}', capture = NULL, result = ?, updated_at = ?"
+                " WHERE job_id = ? AND idx = ?",
+                (json.dumps(item.get("result"), ensure_ascii=False), time.time(), item["job_id"], item["idx"]),
+            )
 
-            cell = worksheet.find(url)
-            row = cell.row
+    def settle(self, item: dict):
+        # パイプラインから出てきた item のうち、失敗したものをリトライ待ち（上限なら failed）に戻す
+        if not item.get("error"):
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " attempts = attempts - ?, lease_owner = NULL, lease_until = NULL, error = ?, updated_at = ?"
+                " WHERE job_id = ? AND idx = ? AND status = 'leased'",
+                (self.max_attempts + (1 if item.get("interrupted") else 0), 1 if item.get("interrupted") else 0,
+                 item["error"], time.time(), item["job_id"], item["idx"]),
+            )
 
-            site_origin = "日本サイト" if is_japanese_site_by_html_or_ocr(url, html, ocr_text) else "海外サイト"
+@st.cache_resource
+def get_job_store() -> JobStore:
+    return JobStore()
+
+def build_job_stages(store: JobStore, writer: "SheetWriter | None", cache: "ResultCache | None" = None, uploader: "DriveUploader | None" = None, dup_index: "NearDupIndex | None" = None) -> list:
+    # build_pipeline_stages と同じ並びで、チェックポイントがある段階は飛ばし、終わった段階は保存する
+    def fetch(item):
+        if "crawl" not in item["checkpoints"]:
+            stage_fetch(item, cache)
+
+    def needs_render(item) -> bool:
+        if "crawl" not in item["checkpoints"]:
+            return True
+        # タイル撮影の場合、保存してあるスクショは縮小した合成画像なので、OCR前に中断した分は撮り直して
+        # 元の解像度のタイルで OCR する（近似重複で OCR を飛ばす分は不要）
+        return (
+            CAPTURE_MODE != "full" and "ocr" not in item["checkpoints"]
+            and item.get("ocr_scope") != "skip" and "ocr" not in item.get("skip_stages", ())
+        )
 
-            score_explanation = (
-                f"{site_origin}\n"
-                f"キーワードスコア: {ocr_point}点\n"
-                f"GPT本文スコア: {gpt_point}点\n"
-                f"GPT画像スコア: {gpt_image_point}点\n"
-                f"[最終スコア]: {final_score}/15"
-            )
+    def render(item):
+        if needs_render(item):
+            stage_render(item, dup_index)
+            store.checkpoint(item, "crawl")
+
+    def ocr(item):
+        if "ocr" not in item["checkpoints"]:
+            stage_ocr(item)
+            store.checkpoint(item, "ocr")
+
+    def gpt(item):
+        text_done = "gpt_text" in item["checkpoints"]
+        image_done = "gpt_image" in item["checkpoints"]
+        if text_done and image_done:
+            return
+        genre_opinion, image_opinion = gpt_judge_both(
+            item["maintext"], item["image_desc"], None if image_done else item["capture"], judge_text=not text_done
+        )
+        if not text_done:
+            item["gpt_opinion"] = genre_opinion
+            item["preclassified"] = "事前分類" in genre_opinion
+            store.checkpoint(item, "gpt_text")
+        if not image_done:
+            item["gpt_image_opinion"] = image_opinion
+            store.checkpoint(item, "gpt_image")
+
+    def io(item):
+        stage_io(item, writer, cache, uploader, on_written=lambda: store.complete(item), dup_index=dup_index)
+        upload = item.get("upload")
+        if upload is None:
+            if writer is None:
+                store.complete(item)
+            return
+
+        def on_uploaded(future):
+            if future.exception() is not None:
+                # S列の書き込み依頼に失敗したのでリトライ待ちに戻す（パイプラインを出た後でも settle できる）
+                store.settle(item)
+                return
+            if future.result():
+                item["drive_url"] = future.result()
+                store.checkpoint(item, "upload")
+            if writer is None:
+                store.complete(item)
+        upload.add_done_callback(on_uploaded)
+
+    return [("fetch", fetch), ("render", render), ("ocr", ocr), ("gpt", gpt), ("io", io)]
+
+# 起動時間の計測（import と クライアント初期化を分けて記録し、初回起動の値はプロセス内で保持する）
+IMPORT_FINISHED = time.perf_counter()
 
-            risk_level = "Unsafe" if final_score >= 11 else "NotSafe" if final_score >= 5 else "Safe"
-
-            worksheet.update_cell(row, 2, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))  # B
-            worksheet.update_cell(row, 18, maintext[:1200])   # R
-            worksheet.update_cell(row, 19, f'=IMAGE("{drive_url}", 1)')  # S
-            worksheet.update_cell(row, 20, gpt_opinion)        # T
-            worksheet.update_cell(row, 21, gpt_image_opinion)  # U
-            worksheet.update_cell(row, 22, keyword_summary)    # V
-            worksheet.update_cell(row, 23, score_explanation)  # W
-            worksheet.update_cell(row, 24, risk_level)         # X
-            # --- [Y列: ジャンル分類] 反映処理 --- #
-            genre_final_match = re.search(r"\[ジャンル\]:\s*([^\n]+)", preferred_opinion)
-            if genre_final_match:
-                genre_final = genre_final_match.group(1).strip()
-                if any(x in genre_final for x in ["要確認", "該当なし", "カテゴリー該当なし"]):
-                    genre_final = "カテゴリー該当なし"
-            else:
-                genre_final = "カテゴリー該当なし"
+@st.cache_resource
+def get_startup_stats() -> dict:
+    return {}
+
+def record_startup() -> dict:
+    now = time.perf_counter()
+    stats = {
+        "import": IMPORT_FINISHED - STARTUP_STARTED,
+        "init": now - IMPORT_FINISHED,
+        "total": now - STARTUP_STARTED,
+    }
+    first = get_startup_stats()
+    if not first:
+        first.update(stats)
+    stats["first_total"] = first["total"]
+    return stats
 
-            worksheet.update_cell(row, 25, genre_final)  # ✅ Y列
 
-        except Exception as e:
-            st.error(f"[{idx}] {url} の処理中にエラー発生: {str(e)}")
-        finally:
-            if shot_path and os.path.isfile(shot_path):
-                try:
-                    os.remove(shot_path)
-                except:
-                    pass
+# Streamlit UI
+COUNTER_LABELS = {"gpt_deduped": "GPT重複リクエストの共有"}
+
+def show_span_summary(recorder: SpanRecorder, key: str = "run"):
+    st.subheader("区間ごとの所要時間")
+    st.dataframe(recorder.summary())
+    if recorder.counters:
+        st.caption(" / ".join(f"{COUNTER_LABELS.get(name, name)}: {value}件" for name, value in sorted(recorder.counters.items())))
+    col_json, col_prom = st.columns(2)
+    col_json.download_button("JSONで保存", recorder.to_json(), file_name="metrics.json", mime="application/json", key=f"{key}_json")
+    col_prom.download_button("Prometheus形式で保存", recorder.to_prometheus(), file_name="metrics.prom", mime="text/plain", key=f"{key}_prom")
+
+def run_job(store: JobStore, job_id: str, worksheet, stage_workers: dict, use_cache: bool, use_near_dup: bool = True):
+    # このセッションをジョブのワーカーの1つとして動かす（途中で切れても続きは他のワーカーや再開で処理できる）
+    progress = st.progress(0)
+    status_text = st.empty()
 
+    start_time = time.time()
+
+    recorder = SpanRecorder()
+    writer = SheetWriter(worksheet, recorder=recorder)
+    cache = get_result_cache() if use_cache else None
+    if GPT_API_KEY:
+        get_gpt_client().reset_dedupe()
+    uploader = DriveUploader()
+    worker_id = store.open_worker()
+    dup_index = get_near_dup_index() if use_near_dup else None
+    pipeline = UrlPipeline(build_job_stages(store, writer, cache, uploader, dup_index), stage_workers, recorder=recorder)
+    done_items = []
+    try:
+        for done_count, item in enumerate(pipeline.run(store.items(job_id, worker_id)), 1):
+            done_items.append(item)
+            store.settle(item)
+            if item.get("error"):
+                st.error(f"[{item['idx']}] {item['url']} の処理中にエラー発生: {item['error']}")
+            cleanup_item(item)
+
+            counts = store.progress(job_id)
+            remaining_count = counts["pending"] + counts["leased"]
             elapsed = time.time() - start_time
-            avg_time = elapsed / idx
-            remaining = avg_time * (len(urls) - idx)
+            avg_time = elapsed / done_count
+            remaining = avg_time * remaining_count
             rem_min, rem_sec = divmod(int(remaining), 60)
-            status_text.text(f"進行中: {idx}/{len(urls)}件 ⏳ 残り予想: {rem_min}分{rem_sec}秒")
-            progress.progress(idx / len(urls))
+            status_text.text(f"進行中: {counts['total'] - remaining_count}/{counts['total']}件 ⏳ 残り予想: {rem_min}分{rem_sec}秒")
+            progress.progress((counts["total"] - remaining_count) / max(1, counts["total"]))
+
+        ocr_times = [
+            {"No.": item["idx"], "URL": item["url"], "OCR範囲": item.get("ocr_scope", ""), "OCR秒": round(item.get("ocr_seconds", 0.0), 2)}
+            for item in done_items
+        ]
+        with st.expander("URLごとのOCR時間"):
+            st.dataframe(ocr_times)
+
+        status_text.text("Drive へのアップロード完了待ち…")
+        uploader.close()
+        for error in uploader.errors:
+            st.error(f"❌ Drive アップ失敗: {error}")
+        for item in done_items:
+            if item.get("upload") is not None and item["upload"].exception() is not None:
+                st.error(f"[{item['idx']}] {item['url']} の書き込み準備中にエラー発生: {item['error']}")
+        if uploader.permission_errors:
+            st.warning(
+                f"⚠️ 公開権限の設定に失敗しましたが、親フォルダの設定により閲覧可能な場合は問題ありません。"
+                f"（{len(uploader.permission_errors)}件）\n{uploader.permission_errors[0]}"
+            )
+
+        try:
+            writer.close()
+        except Exception as e:
+            st.error(f"❌ シート書き込み失敗: {e}")
+    finally:
+        store.close_worker(worker_id)
+
+    show_span_summary(recorder)
+
+    if cache is not None:
+        cache_hits = sum(1 for item in done_items if item.get("cache_hit"))
+        cache_misses = sum(1 for item in done_items if item.get("cache_hit") is False)
+        st.info(f"キャッシュ: ヒット {cache_hits}件 / ミス {cache_misses}件")
+
+    preclassified = sum(1 for item in done_items if is_preclassified(item))
+    if preclassified:
+        st.info(f"事前分類: GPT本文判定を {preclassified}件省略しました")
+
+    clusters = near_dup_clusters(item["near_dup"]["url"] for item in done_items if item.get("near_dup"))
+    if clusters:
+        reused = sum(cluster["件数"] - 1 for cluster in clusters)
+        st.info(f"近似重複: {reused}件は判定済みページの結果を流用（OCR・GPTを省略）")
+        with st.expander("近似重複のクラスタ"):
+            st.dataframe(clusters)
+
+    decided = cascade_counts(done_items)
+    if decided:
+        st.info(
+            "段階判定で確定（スクショ・OCR・GPTを省略）: "
+            + " / ".join(f"{CASCADE_TIER_LABELS[tier]} {count}件" for tier, count in decided.items())
+        )
 
+    counts = store.progress(job_id)
     total_time = time.time() - start_time
     total_min, total_sec = divmod(int(total_time), 60)
-    st.success(f"判定完了 ✅ 所要時間: {total_min}分{total_sec}秒")
\ No newline at end of file
+    st.success(f"判定完了 ✅ 所要時間: {total_min}分{total_sec}秒（ジョブ全体: 完了 {counts['done']}件 / 失敗 {counts['failed']}件 / 残り {counts['pending'] + counts['leased']}件）")
+
+def main():
+    st.title("Web Unsafe 半定")
+
+    missing_vars = missing_env_vars()
+    if missing_vars:
+        st.error(f"❌ 次の変数が設定されてません。: {', '.join(missing_vars)}")
+        st.stop()
+    try:
+        worksheet = get_worksheet()
+        rule_store = get_rule_store()
+        rules = rule_store.refresh(force=st.button("ルール再読込"))
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        st.stop()
+    startup = record_startup()
+    st.caption(
+        f"起動 {startup['total']:.2f}秒（import {startup['import']:.2f}秒 / 初期化 {startup['init']:.2f}秒）"
+        f"・初回起動 {startup['first_total']:.2f}秒"
+    )
+    st.caption(
+        f"GenreRules: {datetime.datetime.fromtimestamp(rules.loaded_at).strftime('%Y-%m-%d %H:%M:%S')} 読込 / "
+        f"キーワード {sum(len(v) for v in rules.genre_keywords.values())}件・パターン {sum(len(v) for v in rules.url_patterns.values())}件"
+    )
+    urls_input = st.text_area("対象URL一覧", height=200)
+
+    readiness = st.selectbox(
+        "読み込み待ちプロファイル",
+        list(READINESS_PROFILES),
+        index=list(READINESS_PROFILES).index(READINESS_PROFILE) if READINESS_PROFILE in READINESS_PROFILES else 1,
+        help="fast: 静的ページ向け / balanced: 通常 / thorough: 遅延読み込みの多いページ向け",
+    )
+
+    use_cache = st.checkbox("結果キャッシュを使う（前回から変わっていないページはGPT判定を省略）", value=CACHE_TTL_HOURS > 0)
+    use_near_dup = st.checkbox("近似重複ページは判定済みページの結果を流用する（OCR・GPTを省略）", value=True)
+
+    with st.expander("並列数の設定"):
+        stage_workers = {
+            name: int(st.number_input(f"{name} ワーカー数", min_value=1, max_value=32, value=default, key=f"workers_{name}"))
+            for name, default in load_pipeline_workers().items()
+        }
+
+    job_store = get_job_store()
+    if st.button("判定実行"):
+        raw_urls = [u.strip() for u in urls_input.strip().split('\n') if u.strip()]
+        urls = dedupe_urls(raw_urls)
+        if not urls:
+            st.warning("対象URLを入力してください。")
+        else:
+            if len(urls) < len(raw_urls):
+                st.info(f"重複URL {len(raw_urls) - len(urls)}件は1回だけ処理し、同じURLの全ての行に書き込みます。")
+            st.session_state["job_id"] = job_store.create_job(urls, readiness)
+            run_job(job_store, st.session_state["job_id"], worksheet, stage_workers, use_cache, use_near_dup)
+
+    with st.expander("ジョブ（中断したジョブの再開・他のワーカーの進捗確認）"):
+        jobs = job_store.list_jobs()
+        if not jobs:
+            st.write("ジョブはまだありません。")
+        else:
+            labels = {
+                job["id"]: f"{job['id']}（{job['total']}件・{datetime.datetime.fromtimestamp(job['created_at']).strftime('%m/%d %H:%M')}）"
+                for job in jobs
+            }
+            ids = list(labels)
+            job_id = st.selectbox(
+                "ジョブ", ids, format_func=labels.get,
+                index=ids.index(st.session_state["job_id"]) if st.session_state.get("job_id") in ids else 0,
+            )
+            counts = job_store.progress(job_id)
+            st.progress(counts["done"] / max(1, counts["total"]))
+            st.write(f"完了 {counts['done']}件 / 処理中 {counts['leased']}件 / 待ち {counts['pending']}件 / 失敗 {counts['failed']}件")
+            failures = job_store.failures(job_id)
+            if failures:
+                st.dataframe(failures)
+            col_resume, col_retry, col_refresh = st.columns(3)
+            if col_resume.button("このセッションで続きを処理"):
+                run_job(job_store, job_id, worksheet, stage_workers, use_cache, use_near_dup)
+            if col_retry.button("失敗分を再実行待ちに戻す"):
+                st.info(f"{job_store.retry_failed(job_id)}件を再実行待ちに戻しました。")
+            col_refresh.button("進捗を更新")
+
+    with st.expander("1件だけプロファイル（cProfile）"):
+        profile_target = st.text_input("URL", key="profile_url")
+        if st.button("プロファイル実行") and profile_target.strip():
+            try:
+                stats_text, raw_profile, profile_recorder = profile_url(profile_target.strip(), readiness)
+            except Exception as e:
+                st.error(f"❌ プロファイル中にエラー発生: {e}")
+            else:
+                show_span_summary(profile_recorder, key="profile")
+                st.code(stats_text)
+                st.download_button("プロファイル（.prof）を保存", raw_profile, file_name="profile.prof", key="profile_raw")
+
+
+if __name__ == "__main__":
+    main()